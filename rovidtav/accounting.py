@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""
+Deducts the materials used on the tickets from the warehouses of the
+technicians, see the material_accounting endpoint
+"""
+
+from django.contrib.auth.models import User
+from django.db import models, transaction
+from django.db.models import Count, F, Min, Sum
+from django.db.models.functions import Coalesce
+
+from rovidtav import stock
+from rovidtav.models import Accountable, StockEntry, Warehouse
+
+# Number of material rows accounted in one transaction
+BATCH_SIZE = 500
+
+
+def _owner_expression(material_cls):
+    """
+    The user the material is accounted to: its own owner or, if that is
+    not set, the owner of its ticket when the ticket has a single owner
+    """
+    fields = dict((f.name, f) for f in material_cls._meta.get_fields())
+    ticket = fields.get('ticket')
+    if ticket is not None:
+        ticket_owner = ticket.related_model._meta.get_field('owner')
+        if ticket_owner.many_to_one:
+            return Coalesce('owner', 'ticket__owner',
+                            output_field=models.IntegerField())
+    return F('owner')
+
+
+def _warehouses():
+    """
+    The warehouse of each technician, the first one if there are more
+    """
+    return dict(Warehouse.objects.filter(owner__isnull=False)
+                .values('owner').annotate(first=Min('pk'))
+                .values_list('owner', 'first'))
+
+
+def account_materials(user, batch_size=BATCH_SIZE):
+    """
+    Accounts every material row not accounted yet, the deductions are
+    recorded in the stock ledger by user. The rows without an owner or a
+    warehouse are left as they are and reported in errors. Returns the
+    number of accounted and failed rows and the errors.
+    """
+    accounted = 0
+    failed = 0
+    errors = []
+    warehouses = _warehouses()
+
+    for material_cls in Accountable.__subclasses__():
+        pending = material_cls.objects.filter(accounted=False) \
+            .annotate(account_to=_owner_expression(material_cls))
+
+        for pk in pending.filter(account_to__isnull=True) \
+                .values_list('pk', flat=True):
+            failed += 1
+            errors.append(u'NO OWNER {} ID {}'.format(material_cls.__name__,
+                                                      pk))
+
+        homeless = list(pending.exclude(account_to__isnull=True)
+                        .exclude(account_to__in=warehouses.keys())
+                        .values('account_to').annotate(count=Count('pk'))
+                        .order_by())
+        owner_ids = [row['account_to'] for row in homeless]
+        usernames = dict(User.objects.filter(pk__in=owner_ids)
+                         .values_list('pk', 'username'))
+        for row in homeless:
+            failed += row['count']
+            err = u'NO WAREHOUSE {}'.format(usernames.get(row['account_to']))
+            if err not in errors:
+                errors.append(err)
+
+        ready = pending.filter(account_to__in=warehouses.keys())
+        last_pk = 0
+        while True:
+            candidates = list(ready.filter(pk__gt=last_pk).order_by('pk')
+                              .values_list('pk', flat=True)[:batch_size])
+            if not candidates:
+                break
+            last_pk = candidates[-1]
+
+            with transaction.atomic():
+                # Accounted by a concurrent request in the meantime
+                pks = list(material_cls.objects.select_for_update()
+                           .filter(pk__in=candidates, accounted=False)
+                           .values_list('pk', flat=True))
+                totals = {}
+                for row in material_cls.objects.filter(pk__in=pks) \
+                        .annotate(account_to=_owner_expression(material_cls)) \
+                        .values('account_to', 'material') \
+                        .annotate(total=Sum('amount')).order_by():
+                    key = (warehouses[row['account_to']], row['material'])
+                    totals[key] = totals.get(key, 0) + row['total']
+                stock.take_many(totals, StockEntry.CONSUMPTION, user)
+                material_cls.objects.filter(pk__in=pks).update(accounted=True)
+            accounted += len(pks)
+
+    return {
+        'accounted': accounted,
+        'failed': failed,
+        'errors': errors,
+    }
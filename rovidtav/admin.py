@@ -1,16 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import os
+import base64
 import codecs
 from copy import copy
-import StringIO
-import zipfile
 import datetime
-import random
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.header import Header
-from email.utils import formataddr
 from _collections import defaultdict
 
 import pytz
@@ -24,21 +18,21 @@ from django.contrib.admin.sites import AdminSite
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
 from django.contrib.auth.models import Group
-from django.http.response import HttpResponse
-from django.template.loader import render_to_string
+from django.db.models import Count
+from django.http.response import HttpResponse, StreamingHttpResponse
 from django.shortcuts import redirect, render
 from openpyxl import Workbook
 from openpyxl.reader.excel import load_workbook
 from openpyxl.writer.excel import save_virtual_workbook
 
-from rovidtav import settings
+from rovidtav import settings, notifications, refcache, stock
 from rovidtav.settings import WKHTMLTOPDF_EXEC
 from inline_actions.admin import InlineActionsModelAdminMixin
 from rovidtav.admin_helpers import ModelAdminRedirect, is_site_admin,\
     CustomDjangoObjectActions, HideIcons, SpecialOrderingChangeList,\
     DeviceOwnerListFilter, get_unread_messages_count,\
-    get_unread_messages, send_assign_mail, ContentTypes, create_warehouses,\
-    find_pattern, find_device_type
+    get_unread_messages, ContentTypes, create_warehouses,\
+    find_pattern, find_device_type, iter_batches, stream_zip
 from rovidtav.admin_inlines import AttachmentInline, DeviceInline, NoteInline,\
     TicketInline, HistoryInline, MaterialInline, WorkItemInline,\
     TicketDeviceInline, SystemEmailInline, NTAttachmentInline, MMDeviceInline,\
@@ -154,8 +148,8 @@ class NTAttachmentAdmin(HideOnAdmin, ModelAdminRedirect):
                 if dev_type not in ('EEP',):
                     dev_type = dev_type[0]
                 city, address = self._get_address(raw_address, obj.ticket)
-                dev_type_obj, _ = NTNEType.objects.get_or_create(type_str=type_str,
-                                                                 type=dev_type)
+                dev_type_obj, _ = refcache.ntne_types.get_or_create(
+                    type_str=type_str, type=dev_type)
                 NetworkTicketNetworkElement.objects.get_or_create(
                     address=address, city=city, ticket=form.instance.ticket,
                     ext_id=ext_id, type=dev_type_obj)
@@ -766,66 +760,15 @@ class MaterialMovementAdmin(CustomDjangoObjectActions,
     new_device.css_class = 'addlink'
 
     def finalize(self, request, obj):
-
-        def _substract(warehouse, movement):
-            to_go = movement.amount
-            for material in WarehouseMaterial.objects.filter(
-                    material=movement.material, warehouse=warehouse):
-                if movement.amount < material.amount:
-                    material.amount -= movement.amount
-                    material.save()
-                    break
-                elif material.amount < to_go:
-                    to_go -= movement.amount
-                    material.delete()
-
-            if to_go:
-                # Some elements remained and could not be sobstracted
-                # ADD MESSAGE?
-                pass
-
-            return to_go
-
-        for movement in MaterialMovementMaterial.objects.filter(materialmovement=obj):
-            # Substract from source
-            _substract(obj.source, movement)
-
-            # Add to target
-            material = WarehouseMaterial.objects.filter(
-                material=movement.material, warehouse=obj.target)
-            if not material:
-                WarehouseMaterial.objects.create(
-                    material=movement.material, warehouse=obj.target,
-                    amount=movement.amount, created_by=request.user,
-                    location=movement.location_to)
-            else:
-                material = random.choice(material)
-                material.amount += movement.amount
-                if movement.location_to:
-                    material.location = movement.location_to
-                material.save()
-
-        to_warehouse = obj.target.owner is None
-        for dre in DeviceReassignEvent.objects.filter(materialmovement=obj):
-            if to_warehouse:
-                dre.device.end_life()
-            else:
-                dre.device.start_clean()
-
-            try:
-                device_owner = DeviceOwner.objects.get(device=dre.device)
-                device_owner.content_type = ContentTypes.warehouse
-                device_owner.object_id = obj.target.id
-                device_owner.save(user=request.user)
-            except DeviceOwner.DoesNotExist:
-                device_owner = DeviceOwner.objects.create(
-                    device=dre.device, content_type=ContentTypes.warehouse,
-                    object_id=obj.target.id)
-
-        obj.finalized = True
-        obj.save()
-        messages.add_message(request, messages.INFO,
-                             u'{} véglegesítve'.format(obj.delivery_num))
+        # Very large deliveries can be finalized with the finalize_movement
+        # command as well, it shows the progress
+        if stock.finalize(obj, request.user):
+            messages.add_message(request, messages.INFO,
+                                 u'{} véglegesítve'.format(obj.delivery_num))
+        else:
+            messages.add_message(request, messages.WARNING,
+                                 u'{} már véglegesítve volt'
+                                 u''.format(obj.delivery_num))
         return redirect('/admin/rovidtav/materialmovement')
 
     finalize.label = u'Véglegesít'
@@ -909,6 +852,18 @@ class WarehouseAdmin(CustomDjangoObjectActions,
             del actions['delete_selected']
         return actions
 
+    def get_queryset(self, request):
+        return super(WarehouseAdmin, self).get_queryset(request) \
+            .annotate(_num_materials=Count('warehousematerial'))
+
+    def save_formset(self, request, form, formset, change):
+        if formset.model is not WarehouseMaterial:
+            return super(WarehouseAdmin, self).save_formset(
+                request, form, formset, change)
+        # Only the location of the balances can be changed here
+        for row in formset.save(commit=False):
+            stock.relocate(row, request.user)
+
     def _add_device_summary(self, obj):
         """
         Adds a summary of the device type counts to the general tab as
@@ -988,9 +943,10 @@ class WarehouseAdmin(CustomDjangoObjectActions,
     num_devices.short_description = u'Eszközök'
 
     def num_materials(self, obj):
-        return WarehouseMaterial.objects.filter(warehouse=obj).count()
+        return obj._num_materials
 
     num_materials.short_description = u'Anyagok'
+    num_materials.admin_order_field = '_num_materials'
 
 
 class _TicketFields(object):
@@ -1236,21 +1192,20 @@ class TicketAdmin(CustomDjangoObjectActions,
         return actions
 
     def download_action(self, request, queryset):
-        temp = StringIO.StringIO()
-        with zipfile.ZipFile(temp, 'w') as archive:
-            for ticket in queryset:
-                attachments = []
-                for att in Attachment.objects.filter(ticket=ticket):
-                    if (att.is_image() and not att.name.lower().startswith('imdb')) or \
-                             att.name.endswith('.pdf'):
-                        attachments.append(att)
-                for att in attachments:
-                    archive.writestr('{}/{}'.format(ticket.ext_id, unidecode(att.name)),
-                                     att.data)
-
-        temp.seek(0)
-        response = HttpResponse(temp,
-                                content_type='application/force-download')
+        ext_ids = dict(queryset.values_list('pk', 'ext_id'))
+
+        def _entries():
+            attachments = Attachment.objects \
+                .filter(ticket__in=list(ext_ids.keys()))
+            for att in iter_batches(attachments):
+                if (att.is_image() and not att.name.lower().startswith('imdb')) or \
+                        att.name.endswith('.pdf'):
+                    name = '{}/{}'.format(ext_ids[att.ticket_id],
+                                          unidecode(att.name))
+                    yield name, att
+
+        response = StreamingHttpResponse(
+            stream_zip(_entries()), content_type='application/force-download')
         fname = datetime.datetime.now().strftime('jegyek_%y%m%d%H%M.zip')
         response['Content-Disposition'] = 'attachment; filename="{}"'.format(fname)
         return response
@@ -1325,44 +1280,7 @@ class TicketAdmin(CustomDjangoObjectActions,
         """
         notify = obj.save()
         if notify and obj.owner and obj.owner.email:
-            try:
-                ticket_html = Attachment.objects.get(
-                    ticket=obj, name='Hibajegy.html').data
-            except Attachment.DoesNotExist:
-                ticket_html = ''
-            ticket_url = ('{}/admin/rovidtav/ticket/{}'
-                          ''.format(settings.SELF_URL, obj.pk))
-
-            html_maxlen = 100000
-            attachment = None
-            if ticket_html and len(ticket_html) > html_maxlen:
-                try:
-                    attachment = \
-                        MIMEText(ticket_html.encode('utf-8'), 'html', 'UTF-8')
-                except Exception:
-                    attachment = MIMEText(ticket_html, 'html', 'UTF-8')
-                attachment.add_header(
-                    u'Content-Disposition',
-                    u'attachment; filename=hibajegy.html',
-                )
-            ctx = {'ticket_url': ticket_url,
-                   'ticket_html': '' if attachment else ticket_html,
-                   'ticket_too_long': bool(attachment)}
-
-            msg = MIMEMultipart()
-            msg['Subject'] = u'Új jegy - {} {} - Task Nr: {}'.format(
-                obj.city.name, obj.address, obj.ext_id)
-            msg_from = formataddr((str(Header(u'Rövidtáv rendszer', 'utf-8')), settings.EMAIL_SENDER))
-            msg['From'] = msg_from
-            msg['To'] = obj.owner.email
-            html_template = render_to_string('assign_notification.html',
-                                             context=ctx)
-            msg.attach(MIMEText(html_template, 'html', 'utf-8'))
-
-            if attachment:
-                msg.attach(attachment)
-
-            send_assign_mail(msg, obj)
+            notifications.queue_assignment(obj)
 
     # =========================================================================
     # FIELDS
@@ -1473,7 +1391,8 @@ class TicketAdmin(CustomDjangoObjectActions,
         try:
             map_img = Attachment.objects.get(ticket=ticket,
                                              name__istartswith='imdb')
-            map_img = map_img._data
+            with map_img.data as blob:
+                map_img = base64.b64encode(blob.read())
         except Attachment.DoesNotExist:
             map_img = None
 
@@ -1859,40 +1778,35 @@ class NetworkTicketAdmin(CustomDjangoObjectActions,
     # =========================================================================
 
     def download_action(self, request, queryset):
-        temp = StringIO.StringIO()
-        att_count = 0
-        with zipfile.ZipFile(temp, 'w') as archive:
-            for ticket in queryset:
-                attachments = []
-                for att in NTAttachment.objects.filter(ticket=ticket):
-                    if att.is_image():
-                        name = ticket.address.replace(u'/', u'-') + u'_{}'.format(att.name)
-                        attachments.append((name, att))
-                        att_count += 1
-                elements = NetworkTicketNetworkElement.objects\
-                    .filter(ticket=ticket)
-                for idx, att in enumerate(
-                        NTNEAttachment.objects
-                        .filter(network_element__in=elements)
-                        .prefetch_related('network_element')):
-                    if att.is_image() or att.name.endswith(('.xls', '.xlsx')):
-                        ext = att.name.split('.')[-1]
-                        name = u'{}_{}_{}.{}'.format(
-                            att.network_element.ext_id,
-                            att.network_element.address,
-                            str(idx+1), ext)
-                        attachments.append((name, att))
-                        att_count += 1
-                for name, att in attachments:
-                    archive.writestr(name, att.data)
-
-        if att_count == 0:
+        addresses = dict(queryset.values_list('pk', 'address'))
+        attachments = []
+        for att in NTAttachment.objects \
+                .filter(ticket__in=list(addresses.keys())).order_by('pk'):
+            if att.is_image():
+                name = addresses[att.ticket_id].replace(u'/', u'-') + \
+                    u'_{}'.format(att.name)
+                attachments.append((name, att))
+        for ticket_id in addresses:
+            elements = NetworkTicketNetworkElement.objects\
+                .filter(ticket_id=ticket_id)
+            for idx, att in enumerate(
+                    NTNEAttachment.objects
+                    .filter(network_element__in=elements)
+                    .prefetch_related('network_element')):
+                if att.is_image() or att.name.endswith(('.xls', '.xlsx')):
+                    ext = att.name.split('.')[-1]
+                    name = u'{}_{}_{}.{}'.format(
+                        att.network_element.ext_id,
+                        att.network_element.address,
+                        str(idx+1), ext)
+                    attachments.append((name, att))
+
+        if not attachments:
             messages.add_message(request, messages.INFO, u'A kiválasztott jegyek nem tartalmaznak képeket')
             return
         fname = datetime.datetime.now().strftime('halozat_jegyek_%y%m%d%H%M.zip')
-        temp.seek(0)
-        response = HttpResponse(temp,
-                                content_type='application/force-download')
+        response = StreamingHttpResponse(
+            stream_zip(attachments), content_type='application/force-download')
         response['Content-Disposition'] = 'attachment; filename="{}"'.format(fname)
         return response
 
@@ -1,10 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import os
-import thread
-import smtplib
-import time
 import re
+import zipfile
 from collections import defaultdict, OrderedDict
 
 from unidecode import unidecode
@@ -25,9 +23,9 @@ from inline_actions.admin import InlineActionsMixin
 from django_messages.models import Message
 from django.db.utils import OperationalError
 
-from rovidtav.models import DeviceOwner, Const, SystemEmail, \
-    MaterialMovementMaterial, Warehouse, Device, DeviceType
-import settings
+from rovidtav.models import DeviceOwner, Const, \
+    MaterialMovementMaterial, Warehouse, Device
+from rovidtav import refcache
 
 
 def _get_ct(model, app_label='rovidtav'):
@@ -122,7 +120,8 @@ def find_pattern(device_type):
 
 def find_device_type(device, device_type=None):
     if not device_type:
-        types = DeviceType.objects.filter(sn_pattern__isnull=False)
+        types = [dt for dt in refcache.device_types.all()
+                 if dt.sn_pattern is not None]
     else:
         types = [device_type]
     matched = 0
@@ -435,6 +434,33 @@ class ModelAdminRedirect(admin.ModelAdmin):
         return None
 
 
+class ZipStreamBuffer(object):
+
+    """
+    Write-only file object for zipfile.ZipFile, collecting the output
+    between two drain() calls, so the archive can be streamed entry by entry
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._pos += len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
 # ============================================================================
 # METHODS
 # ============================================================================
@@ -514,35 +540,49 @@ def get_unread_messages(user):
         return {}
 
 
-def send_assign_mail(msg, obj):
+# Content types which are compressed already, deflating them again only
+# burns CPU
+ZIP_STORED_CONTENT_TYPES = ('image/jpeg', 'image/png', 'image/tiff',
+                            'application/pdf',
+                            'application/vnd.openxmlformats-officedocument'
+                            '.spreadsheetml.sheet')
+
+
+def iter_batches(queryset, batch_size=100):
     """
-    Sends an email in a new thread to avoid the ~5s wait required for sending
-    through smtp
+    Iterates over a queryset in primary key ordered batches, so only one
+    batch of model instances is in memory at a time
     """
-    def _send_email(msg, obj, mail_obj):
-        for retry in range(6):
-            try:
-                smtp = smtplib.SMTP_SSL(settings.SMTP_SERVER)
-                # smtp.set_debuglevel(True)
-                smtp.login(settings.SMTP_USER, settings.SMTP_PASS)
-                smtp.sendmail(settings.EMAIL_SENDER, obj.owner.email,
-                              msg.as_string())
-                mail_obj.status = Const.EmailStatus.SENT
-                mail_obj.remark = (u'Sikeresen elküldve neki: {}'
-                                   u''.format(obj.owner.username))
-                mail_obj.save()
-            except Exception as e:
-                print e
-                if retry == 5:
-                    mail_obj.status = Const.EmailStatus.ERROR
-                    mail_obj.remark = e
-                    mail_obj.save()
-                    raise e
-                time.sleep(30*(retry+1))
-                continue
-            else:
-                break
+    last_pk = None
+    while True:
+        batch = queryset.order_by('pk')
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        batch = list(batch[:batch_size])
+        if not batch:
+            break
+        for obj in batch:
+            yield obj
+        last_pk = batch[-1].pk
+
 
-    mail_obj = SystemEmail.objects.create(content_object=obj)
-    mail_obj.save()
-    thread.start_new_thread(_send_email, (msg, obj, mail_obj))
+def stream_zip(entries):
+    """
+    Generator writing a zip archive of (name, attachment) entries. Yields the
+    archive in chunks, one attachment is held in memory at a time
+    """
+    buff = ZipStreamBuffer()
+    archive = zipfile.ZipFile(buff, 'w', zipfile.ZIP_DEFLATED,
+                              allowZip64=True)
+    for name, att in entries:
+        info = zipfile.ZipInfo(name, att.created_at.timetuple()[:6])
+        info.external_attr = 0o644 << 16
+        if att.content_type in ZIP_STORED_CONTENT_TYPES:
+            info.compress_type = zipfile.ZIP_STORED
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+        with att.data as blob:
+            archive.writestr(info, blob.read())
+        yield buff.drain()
+    archive.close()
+    yield buff.drain()
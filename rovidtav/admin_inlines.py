@@ -53,13 +53,9 @@ class BaseAttachmentInline(RemoveInlineAction,
     def has_delete_permission(self, request, obj=None):
         return False
 
+    # Only overridden to carry the confirm prompt naming the attachment
     def remove(self, request, ticket, obj):
         super(BaseAttachmentInline, self).remove(request, ticket, obj)
-        try:
-            ticket.refresh_has_images()
-        except AttributeError:
-            # Not maintaining has_images boolean
-            pass
 
     remove.onclick = u'return confirm(\'{name} - T&ouml;rl&eacute;s?\')'
     remove.short_description = u'T&ouml;rl&eacute;s'
@@ -72,13 +68,16 @@ class BaseAttachmentInline(RemoveInlineAction,
         return obj.remark or ''
 
     def f_thumbnail(self, obj):
-        if obj.is_image():
-            clickable_txt = (u'<img src="/api/v1/{}/{}" />'
-                             u''.format(self.thumbnail_lnk, obj.pk))
+        # The src is filled in by the inline template from the thumbnail
+        # bundle of the whole gallery, data-src is the fallback
+        img = (u'<img data-thumbnail-id="{1}" data-src="/api/v1/{0}/{1}" />'
+               u''.format(self.thumbnail_lnk, obj.pk))
+        if obj.is_image() and not obj.processed:
+            clickable_txt = u'{}<br />Feldolgozás alatt...'.format(img)
+        elif obj.is_image():
+            clickable_txt = img
         else:
-            clickable_txt = (u'<img src="/api/v1/{}/{}" />'
-                             u'<br />{}'.format(self.thumbnail_lnk,
-                                                obj.pk, obj.name))
+            clickable_txt = u'{}<br />{}'.format(img, obj.name)
 
         if obj.content_disposition.startswith(u'inline'):
             download = u''
@@ -208,12 +207,24 @@ class MMMaterialReadonlyInline(BaseMaterialInline, ReadOnlyCompactInline):
 
 class WarehouseMaterialInline(BaseMaterialInline, CompactInline):
 
+    """
+    The stock balances of the warehouse, changed through rovidtav.stock
+    """
+
     model = WarehouseMaterial
     extra = 0
+    can_delete = False
     readonly_fields = ['amount']
     fields = ('f_material_name', 'location',
               'f_material_category', 'amount', 'f_material_unit', )
 
+    def has_add_permission(self, request):
+        return False
+
+    def get_queryset(self, request):
+        return super(WarehouseMaterialInline, self).get_queryset(request) \
+            .select_related('material__category')
+
 
 class BaseWorkItemInline(RemoveInlineAction,
                          ShowCalcFields, ReadOnlyCompactInline):
@@ -398,7 +409,8 @@ class SystemEmailInline(GenericReadOnlyStackedInline):
     verbose_name = u'Email'
     verbose_name_plural = u'Emailek'
     model = SystemEmail
-    fields = ('status', 'remark', 'created_by', 'created_at')
+    fields = ('status', 'remark', 'recipient', 'attempts', 'next_attempt_at',
+              'sent_at', 'created_by', 'created_at')
     ordering = ('-created_at',)
 
 
@@ -21,15 +21,21 @@ from rovidtav.api.v1.views import \
     download_mmattachment, download_mmthumbnail, email_stats, \
     create_uninstall_ticket, download_uninstattachment, \
     download_uninstthumbnail, download_ntnethumbnail, download_ntneattachment,\
-    download_iwiattachment, download_iwithumbnail, material_accounting
+    download_iwiattachment, download_iwithumbnail, material_accounting, \
+    download_thumbnails, bulk_create_ticket, bulk_create_uninstall_ticket, \
+    ingest_status, bulk_add_ticket_attachment
 
 
 urlpatterns = [
     # Creation/control endpoitns
     url(r'^ticket/create', create_ticket),
+    url(r'^ticket/bulk_create', bulk_create_ticket),
     url(r'^ticket/attachment', add_ticket_attachment),
+    url(r'^ticket/bulk_attachment', bulk_add_ticket_attachment),
     url(r'^uninstall_ticket/create', create_uninstall_ticket),
+    url(r'^uninstall_ticket/bulk_create', bulk_create_uninstall_ticket),
     url(r'^material_accounting', material_accounting),
+    url(r'^ingest/(?P<job_id>\d+)$', ingest_status),
 
     # Statictics endpoints
     url(r'^email_stats$', email_stats),
@@ -47,4 +53,9 @@ urlpatterns = [
     url(r'^uninstthumbnail/(?P<attachment_id>\d+)$', download_uninstthumbnail),
     url(r'^iwiattachment/(?P<attachment_id>\d+)$', download_iwiattachment),
     url(r'^iwithumbnail/(?P<attachment_id>\d+)$', download_iwithumbnail),
+
+    # All thumbnails of a ticket, network element, etc. in one response
+    url(r'^(?P<thumbnail_lnk>thumbnail|ntthumbnail|ntnethumbnail|mmthumbnail|'
+        r'uninstthumbnail|iwithumbnail)s/(?P<parent_id>\d+)$',
+        download_thumbnails),
 ]
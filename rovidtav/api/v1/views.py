@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import io
+import re
+import base64
+import hashlib
 import json
 import codecs
 import os
-import datetime
+import calendar
 
-from PIL import Image, ExifTags
+from PIL import Image
 import StringIO
 
 from rest_framework.authentication import (SessionAuthentication,
@@ -16,7 +20,8 @@ from rest_framework.response import Response
 from rest_framework.decorators import api_view
 from rest_framework.decorators import authentication_classes
 from rest_framework.decorators import permission_classes
-from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count
 
 try:
     from rovidtav.settings import IMAGE_THUMB_PX, STATIC_ROOT
@@ -24,401 +29,505 @@ except ImportError:
     from rovidtav.settings import IMAGE_THUMB_PX, STATICFILES_DIRS
     STATIC_ROOT = STATICFILES_DIRS[0]
 
-from rovidtav.api.field_const import Fields
+from rovidtav import accounting, ingest, jsonstream
+from rovidtav.thumbnails import get_thumbnail_cache
+from rovidtav.imaging import render
 from rovidtav.models import (
-    Client, City, Ticket, TicketType, Note, DeviceType, Device, Attachment,
-    DeviceOwner, SystemEmail, Const, NTAttachment, MMAttachment, Tag,
-    UninstallTicket, UninstAttachment, UninstallTicketRule, NTNEAttachment,
-    IWIAttachment, Accountable, Warehouse)
-from django.http.response import HttpResponse
+    Attachment, SystemEmail, Const, NTAttachment, MMAttachment,
+    UninstAttachment, NTNEAttachment, IWIAttachment, IngestJob)
+from django.http.response import (
+    HttpResponse, FileResponse, StreamingHttpResponse, HttpResponseNotModified)
+from django.utils.http import (
+    http_date, parse_etags, parse_http_date_safe, quote_etag)
 
 
 def _error(data):
     return Response({'error': data})
 
 
-def _create_ticket(ticket_cls, attachment_cls, request, post_processor=None):
-    req_keys = (Fields.CITY, Fields.ZIP, Fields.STREET, Fields.HOUSE_NUM,
-                Fields.NAME1, Fields.MT_ID, Fields.TASK_TYPE, Fields.TICKET_ID,
-                )  # Fields.PHONE1)
+def _ingest_error(e):
+    response = {'error': e.args[0]}
+    if e.ticket_id:
+        response['ticket_id'] = e.ticket_id
+    return response
 
-    # data = json.loads(unicode(request.read(), 'latin-1').encode('utf-8'))
-    data = json.loads(request.read())
 
-    if not all(key in data for key in req_keys):
-        missing_keys = list(set(req_keys) - set(data.keys()))
-        return _error({'missing_keys': missing_keys})
+def _process(request, kind):
+    """
+    Processes a create payload right away, or queues it when the async
+    query parameter is set. Queued payloads are answered with 202 and the
+    id of the job, see ingest_status.
+    """
+    if request.GET.get('async'):
+        job, _ = ingest.enqueue(kind, request.read(), request.user,
+                                key=request.META.get('HTTP_IDEMPOTENCY_KEY'))
+        return Response(_job_status(job), status=202)
 
+    # The attachments are spilled into temporary files while the body is
+    # parsed, they are never held in memory as a whole
     try:
-        ticket_cls.objects.get(ext_id=data[Fields.TICKET_ID])
-        return _error('duplicate ticket: {}'.format(data[Fields.TICKET_ID]))
-    except ticket_cls.DoesNotExist:
-        pass
-    except ticket_cls.MultipleObjectsReturned:
-        return _error('duplicate ticket;'
-                      ' multiple tickets with id {}'
-                      ''.format(data[Fields.TICKET_ID]))
-
-    city, _ = City.objects.get_or_create(
-        name=data[Fields.CITY],
-        zip=int(data[Fields.ZIP]),
-    )
-
-    mt_id = str(data.get(Fields.FLIP_ID) or data.get(Fields.MT_ID))
-    addr = u'{} {}'.format(data[Fields.STREET],
-                           data[Fields.HOUSE_NUM])
-
+        data = jsonstream.load(request, spill=ingest.SPILL[kind])
+    except ValueError as e:
+        return _error('Invalid JSON: {}'.format(e))
     try:
-        client = Client.objects.get(mt_id=mt_id,
-                                    city=city,
-                                    name__startswith=data[Fields.NAME1][0])
-    except Client.DoesNotExist:
-        phone1 = data.get(Fields.PHONE1, u'')
-        phone2 = data.get(Fields.PHONE2, u'')
-        if phone1 and phone2:
-            phone = '{}, {}'.format(phone1, phone2)
-        else:
-            phone = phone1 or phone2
-        client = Client.objects.create(
-            mt_id=mt_id,
-            name=data[Fields.NAME1],
-            city=city,
-            address=addr,
-            phone=phone,
-            created_by=request.user,
-        )
-    except Client.MultipleObjectsReturned:
-        client = Client.objects.filter(mt_id=mt_id,
-                                       city=city,
-                                       name__startswith=data[Fields.NAME1][0])[0]
-
-    ticket_types = []
-    if data.get(Fields.TASK_TYPE_LIST):
-        for t in data[Fields.TASK_TYPE_LIST]:
-            ticket_type, _ = TicketType.objects.get_or_create(name=t)
-            ticket_types.append(ticket_type)
-    else:
-        ticket_type, _ = TicketType.objects.get_or_create(
-            name=data[Fields.TASK_TYPE])
-        ticket_types.append(ticket_type)
-
-    if Fields.AGREED_TIME_FROM in data and data[Fields.AGREED_TIME_FROM]:
-        try:
-            time_fmt = '%Y-%m-%d %H:%M:%S'
-            time_from_raw = data[Fields.AGREED_TIME_FROM]
-            time_from = datetime.datetime.strptime(time_from_raw, time_fmt)
-            time_to_raw = data.get(Fields.AGREED_TIME_TO)
-            if time_to_raw:
-                time_to = datetime.datetime.strptime(time_to_raw, time_fmt)
-        except Exception:
-            return _error('Error interpreting agreed times'
-                          ' FROM {} TO {}'
-                          ''.format(data[Fields.AGREED_TIME_FROM],
-                                    data[Fields.AGREED_TIME_TO]))
-    else:
-        time_from = None
-        time_to = None
-
-    ticket = ticket_cls.objects.create(
-        ext_id=data[Fields.TICKET_ID],
-        client=client,
-        city=city,
-        address=addr,
-        created_by=request.user,
-        created_at=data['mail_date'],
-        agreed_time_from=time_from,
-        agreed_time_to=time_to,
-    )
-
+        return Response(ingest.process(kind, data, request.user))
+    except ingest.IngestError as e:
+        return Response(_ingest_error(e))
+
+
+def _bulk_create_tickets(request, kind):
+    """
+    Creates the tickets from a list of payloads in one transaction. Every
+    payload is processed in its own savepoint, the response holds the
+    result of each one in the order of the request.
+    """
+    ticket_cls, attachment_cls, assignee = ingest.TICKET_KINDS[kind]
     try:
-        ticket.ticket_types.add(*ticket_types)
-    except AttributeError:
-        ticket.ticket_type = ticket_types[0]
-        ticket.save()
-
-    if Fields.EXTRA_DEVICES in data and data[Fields.EXTRA_DEVICES]:
-        tag, _ = Tag.objects.get_or_create(name='Extra eszköz')
-        ticket.ticket_tags.add(tag)
-        for device in data[Fields.EXTRA_DEVICES]:
-            tag, _ = Tag.objects.get_or_create(name=device[Fields.EXTRA_DEV_CODE])
-            ticket.ticket_tags.add(tag)
-            tag, _ = Tag.objects.get_or_create(name=device[Fields.EXTRA_DEV_TYPE])
-            ticket.ticket_tags.add(tag)
-            dt, _ = DeviceType.objects.get_or_create(name=device[Fields.EXTRA_DEV_CODE])
-            dev = Device.objects.create(type=dt, sn=u'NINCS KITÖLTVE')
-            DeviceOwner.objects.create(device=dev,
-                                       content_type=client.get_content_type_obj(),
-                                       object_id=client.pk)
-
-    if data.get(Fields.FLIP_ID):
-        tag, _ = Tag.objects.get_or_create(name='Flip')
-        ticket.ticket_tags.add(tag)
-
-    if Fields.REMARKS in data and data[Fields.REMARKS]:
-        Note.objects.create(
-            content_object=ticket,
-            is_history=False,
-            remark=data[Fields.REMARKS],
-            created_by=request.user,
-        )
-
-    if Fields.COLLECTABLE_MONEY in data and data[Fields.COLLECTABLE_MONEY]:
-        Note.objects.create(
-            content_object=ticket,
-            is_history=False,
-            remark=u'Beszedés {}'.format(data[Fields.COLLECTABLE_MONEY]),
-            created_by=request.user,
-        )
-        ticket[Ticket.Keys.COLLECTABLE_MONEY] = data[Fields.COLLECTABLE_MONEY]
-
-    if Fields.DEVICES in data:
-        for device in data[Fields.DEVICES]:
-            if device.get(Fields.DEV_ACTION) == u'Leszerelendő':
-                status = Const.DeviceStatus.TO_UNINSTALL
-            else:
-                status = Const.DeviceStatus.ACTIVE
+        payloads = json.loads(request.read())
+    except ValueError as e:
+        return _error('Invalid JSON: {}'.format(e))
+    if not isinstance(payloads, list):
+        return _error('a list of tickets expected')
+
+    results = []
+    refs = ingest.IngestRefs(ticket_cls)
+    with transaction.atomic():
+        refs.prefetch(payloads)
+        for data in payloads:
+            savepoint = refs.savepoint()
             try:
-                dev = Device.objects.get(
-                    sn=device[Fields.DEV_SN])
-                if dev.status != status:
-                    dev.status = status
-                    dev.save()
-            except Device.DoesNotExist:
-                dev_type, _ = DeviceType.objects.get_or_create(
-                    name=(device[Fields.DEV_TYPE] or '').strip())
-                dev = Device.objects.create(
-                    sn=device[Fields.DEV_SN],
-                    type=dev_type,
-                    status=status,
-                )
-                DeviceOwner.objects.create(
-                    device=dev, content_type=client.get_content_type_obj(),
-                    object_id=client.pk)
-            except Device.MultipleObjectsReturned:
-                # Handle error, now just leave it, probably some old
-                # inconsistency
-                pass
-            if ticket_cls == UninstallTicket and dev and \
-                    dev.uninstall_ticket != ticket:
-                dev.uninstall_ticket = ticket
-                dev.save()
-
-    if 'html' in data:
-        attachment_cls.objects.create(
-            ticket=ticket,
-            name='Hibajegy.html',
-            _data=data['html'].encode('utf-8'),
-            remark=u'A matávtól érkezett eredeti hibajegy',
-            created_by=request.user,
-        )
-
-    for att_name, att_content in data['attachments'].iteritems():
-        attachment_cls.objects.create(
-            ticket=ticket,
-            name=att_name,
-            _data=att_content,
-            created_by=request.user,
-        )
-
-    if post_processor:
-        post_processor(request, ticket)
-
-    return Response({'ticket_id': ticket.pk})
+                with transaction.atomic():
+                    ticket = ingest.ingest_ticket(
+                        ticket_cls, attachment_cls, data, request.user, refs,
+                        assignee)
+            except ingest.IngestError as e:
+                refs.rollback(savepoint)
+                results.append(_ingest_error(e))
+            except Exception as e:
+                refs.rollback(savepoint)
+                results.append({'error': unicode(e)})
+            else:
+                results.append({'ticket_id': ticket.pk})
+        refs.flush()
+
+    return Response({'results': results})
+
+
+def _job_status(job):
+    return {
+        'job_id': job.pk,
+        'status': job.status,
+        'attempts': job.attempts,
+        'result': json.loads(job.result) if job.result else None,
+        'error': json.loads(job.error) if job.error else None,
+    }
 
 
 @api_view(['POST'])
 @authentication_classes((SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def create_ticket(request):
-    return _create_ticket(Ticket, Attachment, request)
+    return _process(request, IngestJob.TICKET)
+
+
+@api_view(['POST'])
+@authentication_classes((SessionAuthentication, BasicAuthentication))
+@permission_classes((IsAuthenticated,))
+def bulk_create_ticket(request):
+    return _bulk_create_tickets(request, IngestJob.TICKET)
 
 
 @api_view(['POST'])
 @authentication_classes((SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def create_uninstall_ticket(request):
+    return _process(request, IngestJob.UNINSTALL_TICKET)
 
-    def auto_assign(request, ticket):
-        rules = UninstallTicketRule.objects.filter(primer=ticket.city.primer)
-        if rules:
-            rule = rules[0]
-            ticket.owner = rule.assign_to
-            ticket.save(user=request.user)
 
-    return _create_ticket(UninstallTicket, UninstAttachment, request, auto_assign)
+@api_view(['POST'])
+@authentication_classes((SessionAuthentication, BasicAuthentication))
+@permission_classes((IsAuthenticated,))
+def bulk_create_uninstall_ticket(request):
+    return _bulk_create_tickets(request, IngestJob.UNINSTALL_TICKET)
 
 
 @api_view(['POST'])
 @authentication_classes((SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def add_ticket_attachment(request):
-    req_keys = (Fields.TICKET_ID, 'attachment_name', 'attachment_content')
-    data = json.loads(request.read())
-    if not all(key in data for key in req_keys):
-        missing_keys = list(set(req_keys) - set(data.keys()))
-        return _error({'missing_keys': missing_keys})
+    return _process(request, IngestJob.TICKET_ATTACHMENT)
 
-    try:
-        ticket = Ticket.objects.get(ext_id=data['ticket_id'])
-    except Ticket.DoesNotExist:
-        return _error('Ticket {} does not exist'.format(data['ticket_id']))
 
-    Attachment.objects.create(
-        ticket=ticket,
-        name=data['attachment_name'],
-        _data=data['attachment_content'],
-        created_by=request.user,
-    )
-    return Response({'OK': 'Done'})
+@api_view(['POST'])
+@authentication_classes((SessionAuthentication, BasicAuthentication))
+@permission_classes((IsAuthenticated,))
+def bulk_add_ticket_attachment(request):
+    return _process(request, IngestJob.TICKET_ATTACHMENTS)
+
+
+@api_view(['GET'])
+@authentication_classes((SessionAuthentication, BasicAuthentication))
+@permission_classes((IsAuthenticated,))
+def ingest_status(request, job_id):
+    try:
+        job = IngestJob.objects.get(pk=job_id)
+    except IngestJob.DoesNotExist:
+        return _error('Job {} does not exist'.format(job_id))
+    return Response(_job_status(job))
 
 
 def _orient_image(attachment, thumbnail=False):
-    temp_buff = StringIO.StringIO()
-    temp_buff.write(attachment.data)
-    temp_buff.seek(0)
+    with attachment.data as blob:
+        return render(blob, attachment.name,
+                      IMAGE_THUMB_PX if thumbnail else None)
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+RANGE_CHUNK_SIZE = 64 * 1024
+
+
+class _Unsatisfiable(object):
+    pass
+
+
+def _last_modified(att):
+    return calendar.timegm(att.created_at.utctimetuple())
+
+
+def _not_modified(request, etag, last_modified):
+    """
+    Evaluates the If-None-Match and If-Modified-Since request headers
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return etag is not None and ('*' in etags or etag in etags)
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified is not None:
+        if_modified_since = parse_http_date_safe(if_modified_since)
+        return bool(if_modified_since and last_modified <= if_modified_since)
+    return False
+
+
+def _requested_range(request, size, etag, last_modified):
+    """
+    Returns the (start, end) byte range requested by the Range header,
+    None if the whole content has to be served or _Unsatisfiable. Only
+    single ranges are supported, multiple ranges get the full content.
+    """
+    range_header = request.META.get('HTTP_RANGE')
+    if not range_header:
+        return None
+
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range:
+        if_range_date = parse_http_date_safe(if_range)
+        if if_range_date is not None:
+            if if_range_date != last_modified:
+                return None
+        elif etag is None or etag not in parse_etags(if_range):
+            return None
+
+    match = RANGE_RE.match(range_header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if not start:
+        # Suffix range, the last N bytes
+        start = max(size - int(end), 0)
+        end = size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return _Unsatisfiable
+    return start, end
 
-    img = Image.open(temp_buff)
-    if thumbnail:
-        img.thumbnail((IMAGE_THUMB_PX, IMAGE_THUMB_PX), Image.ANTIALIAS)
-    temp_buff = StringIO.StringIO()
-    temp_buff.name = attachment.name
 
+def _iter_range(reader, length):
     try:
-        raw_exif = img._getexif() or {}
-    except AttributeError:
-        raw_exif = {}
-    exif = {
-        ExifTags.TAGS[k]: v
-        for k, v in raw_exif.items()
-        if k in ExifTags.TAGS
-    }
+        while length > 0:
+            chunk = reader.read(min(RANGE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        reader.close()
+
+
+def _serve(request, reader, size, content_type, etag=None,
+           last_modified=None):
+    """
+    Serves a seekable file-like object with validators and byte range
+    support
+    """
+    byte_range = _requested_range(request, size, etag, last_modified)
+    if byte_range is _Unsatisfiable:
+        reader.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(size)
+    elif byte_range:
+        start, end = byte_range
+        reader.seek(start)
+        response = StreamingHttpResponse(
+            _iter_range(reader, end - start + 1), status=206,
+            content_type=content_type)
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+        response['Content-Length'] = end - start + 1
+    else:
+        response = FileResponse(reader, content_type=content_type)
+        response['Content-Length'] = size
+
+    response['Accept-Ranges'] = 'bytes'
+    response['Cache-Control'] = 'private'
+    if etag is not None:
+        response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def _validated(request, etag, last_modified):
+    """
+    Returns a 304 response if the client has the current representation
+    """
+    if not _not_modified(request, etag, last_modified):
+        return None
+    response = HttpResponseNotModified()
+    if etag is not None:
+        response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def _download_from_model(request, model, pk):
+    try:
+        att = model.objects.get(pk=pk)
+    except model.DoesNotExist:
+        return _error('File not found')
 
-    orientation = exif.get('Orientation')
-    if orientation == 6:
-        img = img.rotate(-90, expand=True)
-    elif orientation == 8:
-        img = img.rotate(90, expand=True)
-    img.save(temp_buff)
-    temp_buff.seek(0)
+    legacy_image = att.is_image() and not att.oriented
+    if att.blob_hash:
+        # The stored content identifies the representation, except for the
+        # images still rotated on the fly
+        etag = att.blob_hash + ('-o' if legacy_image else '')
+    else:
+        etag = None
+    last_modified = _last_modified(att)
+    response = _validated(request, etag, last_modified)
+    if response:
+        return response
+
+    if legacy_image:
+        # Not yet normalized by the orient_attachments command
+        data = _orient_image(att, thumbnail=False)
+        reader, size = io.BytesIO(data), len(data)
+    elif att.blob_hash:
+        reader, size = att.data, att.size
+    else:
+        data = att.data.read()
+        reader, size = io.BytesIO(data), len(data)
+
+    response = _serve(request, reader, size, att.content_type, etag,
+                      last_modified)
+    response['Content-Disposition'] = att.content_disposition
+    return response
+
+
+def _document_icon():
+    with codecs.open(os.path.join(STATIC_ROOT, 'images',
+                                  'document-icon.png')) as icon:
+        img = Image.open(icon)
+        temp_buff = StringIO.StringIO()
+        temp_buff.name = 'document-icon.png'
+        img.thumbnail((100, 100), Image.ANTIALIAS)
+        img.save(temp_buff)
+        temp_buff.seek(0)
     return temp_buff.read()
 
 
-def _download_from_model(model, pk):
+DOCUMENT_ICON_KEY = 'document-icon_100'
+
+
+def _thumbnail_meta(att):
+    """
+    Returns the cache key, etag, last modification time and content type
+    of the thumbnail of an attachment
+    """
+    if not att.is_image():
+        return DOCUMENT_ICON_KEY, DOCUMENT_ICON_KEY, None, 'image/png'
+    key = get_thumbnail_cache().key(att)
+    etag = u'{}-{}'.format(att.blob_hash, key) if att.blob_hash else None
+    return key, etag, _last_modified(att), att.content_type
+
+
+def _thumbnail_data(att, key):
+    cache = get_thumbnail_cache()
+    if att.is_image():
+        return cache.get_or_create(
+            key, lambda: _orient_image(att, thumbnail=True))
+    return cache.get_or_create(key, _document_icon)
+
+
+def _thumbnail_from_model(request, model, pk):
     try:
         att = model.objects.get(pk=pk)
-        data = _orient_image(att, thumbnail=False) if att.is_image() else att.data
-        response = HttpResponse(data, content_type=att.content_type)
-        response['Content-Disposition'] = att.content_disposition
-        return response
     except model.DoesNotExist:
         return _error('File not found')
 
+    key, etag, last_modified, content_type = _thumbnail_meta(att)
+    response = _validated(request, etag, last_modified)
+    if response:
+        return response
 
-def _thumbnail_from_model(model, pk):
-    try:
-        att = model.objects.get(pk=pk)
+    data = _thumbnail_data(att, key)
+    return _serve(request, io.BytesIO(data), len(data), content_type, etag,
+                  last_modified)
+
+
+# The thumbnail endpoint name of the attachment inlines mapped to the
+# attachment model and its parent foreign key
+THUMBNAIL_BUNDLES = {
+    'thumbnail': (Attachment, 'ticket'),
+    'ntthumbnail': (NTAttachment, 'ticket'),
+    'ntnethumbnail': (NTNEAttachment, 'network_element'),
+    'mmthumbnail': (MMAttachment, 'materialmovement'),
+    'uninstthumbnail': (UninstAttachment, 'ticket'),
+    'iwithumbnail': (IWIAttachment, 'work_item'),
+}
+
+
+def _thumbnail_bundle(request, model, parent_field, parent_id):
+    """
+    Returns every thumbnail of a ticket (network element, etc.) in a single
+    JSON document, base64 encoded. The document icon used for the non-image
+    attachments is sent only once.
+    """
+    attachments = list(model.objects.filter(**{parent_field: parent_id})
+                       .order_by('pk'))
+    metas = [(att, _thumbnail_meta(att)) for att in attachments]
+
+    etag = None
+    if all(meta[1] for _, meta in metas):
+        etag = hashlib.sha1(u'|'.join(
+            u'{}:{}'.format(att.pk, meta[1]) for att, meta in metas
+        ).encode('utf-8')).hexdigest()
+    last_modified = max([meta[2] for _, meta in metas if meta[2]] or [None])
+    response = _validated(request, etag, last_modified)
+    if response:
+        return response
 
+    thumbnails = []
+    document_icon = None
+    for att, (key, _, _, content_type) in metas:
         if att.is_image():
-            return HttpResponse(_orient_image(att, thumbnail=True),
-                                content_type=att.content_type)
-
+            data = base64.b64encode(_thumbnail_data(att, key))
         else:
-            with codecs.open(os.path.join(STATIC_ROOT, 'images',
-                                          'document-icon.png')) as icon:
-                img = Image.open(icon)
-                temp_buff = StringIO.StringIO()
-                temp_buff.name = att.name + '.png'
-                img.thumbnail((100, 100), Image.ANTIALIAS)
-                img.save(temp_buff)
-                temp_buff.seek(0)
-
-            return HttpResponse(temp_buff.read(), content_type='image/png')
-    except model.DoesNotExist:
-        return _error('File not found')
+            data = None
+            if document_icon is None:
+                document_icon = base64.b64encode(_thumbnail_data(att, key))
+        thumbnails.append({
+            'id': att.pk,
+            'content_type': content_type,
+            'data': data,
+        })
+
+    response = HttpResponse(json.dumps({
+        'thumbnails': thumbnails,
+        'document_icon': document_icon,
+    }), content_type='application/json')
+    response['Cache-Control'] = 'private'
+    if etag is not None:
+        response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
 
 
 @api_view(['GET'])
 @authentication_classes((SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def download_attachment(request, attachment_id):
-    return _download_from_model(Attachment, attachment_id)
+    return _download_from_model(request, Attachment, attachment_id)
 
 
 @api_view(['GET'])
 @authentication_classes((SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def download_thumbnail(request, attachment_id):
-    return _thumbnail_from_model(Attachment, attachment_id)
+    return _thumbnail_from_model(request, Attachment, attachment_id)
 
 
 @api_view(['GET'])
 @authentication_classes((SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def download_ntattachment(request, attachment_id):
-    return _download_from_model(NTAttachment, attachment_id)
+    return _download_from_model(request, NTAttachment, attachment_id)
 
 
 @api_view(['GET'])
 @authentication_classes((SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def download_ntthumbnail(request, attachment_id):
-    return _thumbnail_from_model(NTAttachment, attachment_id)
+    return _thumbnail_from_model(request, NTAttachment, attachment_id)
 
 
 @api_view(['GET'])
 @authentication_classes((SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def download_mmattachment(request, attachment_id):
-    return _download_from_model(MMAttachment, attachment_id)
+    return _download_from_model(request, MMAttachment, attachment_id)
 
 
 @api_view(['GET'])
 @authentication_classes((SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def download_mmthumbnail(request, attachment_id):
-    return _thumbnail_from_model(MMAttachment, attachment_id)
+    return _thumbnail_from_model(request, MMAttachment, attachment_id)
 
 
 @api_view(['GET'])
 @authentication_classes((SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def download_uninstattachment(request, attachment_id):
-    return _download_from_model(UninstAttachment, attachment_id)
+    return _download_from_model(request, UninstAttachment, attachment_id)
 
 
 @api_view(['GET'])
 @authentication_classes((SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def download_uninstthumbnail(request, attachment_id):
-    return _thumbnail_from_model(UninstAttachment, attachment_id)
+    return _thumbnail_from_model(request, UninstAttachment, attachment_id)
 
 
 @api_view(['GET'])
 @authentication_classes((SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def download_ntneattachment(request, attachment_id):
-    return _download_from_model(NTNEAttachment, attachment_id)
+    return _download_from_model(request, NTNEAttachment, attachment_id)
 
 
 @api_view(['GET'])
 @authentication_classes((SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def download_ntnethumbnail(request, attachment_id):
-    return _thumbnail_from_model(NTNEAttachment, attachment_id)
+    return _thumbnail_from_model(request, NTNEAttachment, attachment_id)
 
 
 @api_view(['GET'])
 @authentication_classes((SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def download_iwiattachment(request, attachment_id):
-    return _download_from_model(IWIAttachment, attachment_id)
+    return _download_from_model(request, IWIAttachment, attachment_id)
 
 
 @api_view(['GET'])
 @authentication_classes((SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def download_iwithumbnail(request, attachment_id):
-    return _thumbnail_from_model(IWIAttachment, attachment_id)
+    return _thumbnail_from_model(request, IWIAttachment, attachment_id)
 
 
 @api_view(['GET'])
@@ -426,18 +535,19 @@ def download_iwithumbnail(request, attachment_id):
 @permission_classes((IsAuthenticated,))
 def email_stats(request):
     try:
-        emails = SystemEmail.objects.all()
-        total = len(emails)
-        errors = len(emails.filter(status=Const.EmailStatus.ERROR))
-        sent = len(emails.filter(status=Const.EmailStatus.SENT))
-        fixed = len(emails.filter(status=Const.EmailStatus.FIXED))
-        in_progress = len(emails.filter(status=Const.EmailStatus.IN_PROGRESS))
+        counts = dict(SystemEmail.objects.values('status')
+                      .annotate(count=Count('pk'))
+                      .values_list('status', 'count').order_by())
+        # Queued messages which failed at least once
+        retrying = SystemEmail.objects.filter(
+            status=Const.EmailStatus.IN_PROGRESS, attempts__gt=0).count()
         return Response({
-            'total': total,
-            'errors': errors,
-            'sent': sent,
-            'fixed': fixed,
-            'in_progress': in_progress
+            'total': sum(counts.values()),
+            'errors': counts.get(Const.EmailStatus.ERROR, 0),
+            'sent': counts.get(Const.EmailStatus.SENT, 0),
+            'fixed': counts.get(Const.EmailStatus.FIXED, 0),
+            'in_progress': counts.get(Const.EmailStatus.IN_PROGRESS, 0),
+            'retrying': retrying,
         })
     except Exception as e:
         return Response({'error': e})
@@ -447,52 +557,12 @@ def email_stats(request):
 @authentication_classes((SessionAuthentication, BasicAuthentication))
 @permission_classes((IsAuthenticated,))
 def material_accounting(request):
-    items_accounted = 0
-    items_failed = 0
-    errors = []
-    for material_cls in Accountable.__subclasses__():
-        for material_item in material_cls.objects.filter(accounted=False):
-            try:
-                owner = material_item.owner or material_item.ticket.owner
-                if owner.__class__ != User:
-                    raise AttributeError
-            except AttributeError:
-                # Neither ticket, not material has an owner
-                items_failed += 1
-                errors.append('NO OWNER {} ID {}'.format(material_cls.__name__, material_item.id))
-                continue
-            except Exception as e:
-                items_failed += 1
-                errors.append(str(e))
-                # raise e
-                continue
+    return Response(accounting.account_materials(request.user))
 
-            try:
-                wh = Warehouse.objects.get(owner=owner)
-            except Warehouse.DoesNotExist:
-                err = 'NO WAREHOUSE {}'.format(str(owner))
-                if err not in errors:
-                    errors.append(err)
-                items_failed += 1
-                continue
-            materials = wh.warehousematerial_set.filter(material=material_item.material)
-            if not materials:
-                items_accounted += 1
-                material_item.accounted = True
-                material_item.save()
-                continue
-            whmaterial = materials[0]
-            if material_item.amount > whmaterial.amount:
-                whmaterial.delete()
-            else:
-                whmaterial.amount -= material_item.amount
-                whmaterial.save()
-            items_accounted += 1
-            material_item.accounted = True
-            material_item.save()
-
-    return Response({
-        'accounted': items_accounted,
-        'failed': items_failed,
-        'errors': errors,
-    })
+
+@api_view(['GET'])
+@authentication_classes((SessionAuthentication, BasicAuthentication))
+@permission_classes((IsAuthenticated,))
+def download_thumbnails(request, thumbnail_lnk, parent_id):
+    model, parent_field = THUMBNAIL_BUNDLES[thumbnail_lnk]
+    return _thumbnail_bundle(request, model, parent_field, parent_id)
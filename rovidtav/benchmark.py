@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the ingest and download endpoints. Synthetic mail parser
+payloads are sent through the Django test client, see the benchmark_ingest
+management command.
+"""
+
+import json
+import math
+import time
+import base64
+import random
+import resource
+import datetime
+import StringIO
+
+from PIL import Image
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
+
+from rovidtav.api.field_const import Fields
+from rovidtav.models import Attachment, Ticket, WorkItemTicket
+
+CITIES = ((u'Budapest', 1117), (u'Debrecen', 4025), (u'Szeged', 6720),
+          (u'Pécs', 7621), (u'Győr', 9021))
+TASK_TYPES = (u'Hibaelhárítás', u'Kiépítés', u'Áthelyezés', u'Bontás',
+              u'Csere', u'Felülvizsgálat')
+DEVICE_TYPES = (u'Set-top box', u'Kábelmodem', u'ONT', u'Router')
+
+# Regressions are reported when a scenario gets slower or heavier than its
+# baseline by more than this ratio
+DEFAULT_TOLERANCE = 0.2
+
+
+class Config(object):
+    """
+    The shape of the generated payloads
+    """
+
+    def __init__(self, tickets=50, devices=2, ticket_types=1, attachments=1,
+                 attachment_size=64 * 1024, images=1, image_px=1600,
+                 downloads=50, seed=0):
+        self.tickets = tickets
+        self.devices = devices
+        self.ticket_types = ticket_types
+        self.attachments = attachments
+        self.attachment_size = attachment_size
+        self.images = images
+        self.image_px = image_px
+        self.downloads = downloads
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class PayloadFactory(object):
+    """
+    Generates the payloads of the mail parser. The content is random but
+    reproducible with the same seed.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self._image = None
+
+    def _blob(self):
+        size = self.config.attachment_size
+        if not size:
+            return ''
+        return ('%0*x' % (2 * size, self.random.getrandbits(8 * size))) \
+            .decode('hex')
+
+    def image(self):
+        # Noise does not compress, the JPEG has a realistic size. It is
+        # generated once, the hash of the stored content does not matter
+        if self._image is None:
+            px = self.config.image_px
+            img = Image.effect_noise((px, px * 3 / 4), 64).convert('RGB')
+            buf = StringIO.StringIO()
+            img.save(buf, 'JPEG', quality=90)
+            self._image = buf.getvalue()
+        return self._image
+
+    def _attachments(self, ext_id):
+        attachments = {}
+        for idx in range(self.config.attachments):
+            attachments[u'{}_{}.pdf'.format(ext_id, idx)] = \
+                base64.b64encode(self._blob())
+        for idx in range(self.config.images):
+            attachments[u'{}_{}.jpg'.format(ext_id, idx)] = \
+                base64.b64encode(self.image())
+        return attachments
+
+    def ticket(self, ext_id):
+        city, zip = self.random.choice(CITIES)
+        task_types = self.random.sample(
+            TASK_TYPES, min(self.config.ticket_types, len(TASK_TYPES)))
+        devices = [{
+            Fields.DEV_SN: u'SN{}{:04d}'.format(ext_id, idx),
+            Fields.DEV_TYPE: self.random.choice(DEVICE_TYPES),
+            Fields.DEV_ACTION: self.random.choice((u'Leszerelendő', u'')),
+        } for idx in range(self.config.devices)]
+        agreed = datetime.datetime(2017, 1, 1, 8) + datetime.timedelta(
+            hours=self.random.randint(0, 24 * 90))
+
+        return {
+            Fields.TICKET_ID: ext_id,
+            Fields.MT_ID: str(self.random.randint(10 ** 8, 10 ** 9)),
+            Fields.CITY: city,
+            Fields.ZIP: str(zip),
+            Fields.STREET: u'Fő utca',
+            Fields.HOUSE_NUM: str(self.random.randint(1, 200)),
+            Fields.NAME1: u'Teszt Ügyfél {}'.format(ext_id),
+            Fields.PHONE1: u'+3612345678',
+            Fields.TASK_TYPE: task_types[0],
+            Fields.TASK_TYPE_LIST: task_types,
+            Fields.AGREED_TIME_FROM: agreed.strftime('%Y-%m-%d %H:%M:%S'),
+            Fields.AGREED_TIME_TO: (agreed + datetime.timedelta(hours=2))
+            .strftime('%Y-%m-%d %H:%M:%S'),
+            Fields.REMARKS: u'Benchmark',
+            Fields.DEVICES: devices,
+            'mail_date': agreed.strftime('%Y-%m-%dT%H:%M:%S+01:00'),
+            'html': u'<html><body>{}</body></html>'.format(
+                u'<p>Hibajegy</p>' * 200),
+            'attachments': self._attachments(ext_id),
+        }
+
+    def attachment(self, ext_id, idx):
+        return {
+            Fields.TICKET_ID: ext_id,
+            'attachment_name': u'{}_extra_{}.pdf'.format(ext_id, idx),
+            'attachment_content': base64.b64encode(self._blob()),
+        }
+
+
+def _base36(num):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    out = ''
+    while True:
+        num, rem = divmod(num, 36)
+        out = digits[rem] + out
+        if not num:
+            return out
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of a list of numbers
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Scenario(object):
+    """
+    The timings and query counts of the requests of a single endpoint
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.elapsed = []
+        self.queries = []
+        self.errors = 0
+
+    def measure(self, send):
+        """
+        Sends a request with send(), the response is consumed completely
+        """
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.time()
+            response = send()
+            if response.streaming:
+                for _ in response.streaming_content:
+                    pass
+            self.elapsed.append(time.time() - start)
+        self.queries.append(len(ctx.captured_queries))
+        if response.status_code >= 400 or 'error' in _json(response):
+            self.errors += 1
+        return response
+
+    def summary(self):
+        total = sum(self.elapsed)
+        return {
+            'requests': len(self.elapsed),
+            'errors': self.errors,
+            'rps': len(self.elapsed) / total if total else None,
+            'p50_ms': _ms(percentile(self.elapsed, 50)),
+            'p95_ms': _ms(percentile(self.elapsed, 95)),
+            'queries_avg': (float(sum(self.queries)) / len(self.queries)
+                            if self.queries else None),
+            'queries_max': max(self.queries) if self.queries else None,
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def _json(response):
+    if response.streaming or 'json' not in response.get('Content-Type', ''):
+        return {}
+    data = json.loads(response.content)
+    return data if isinstance(data, dict) else {}
+
+
+def _post(client, url, payload):
+    return client.post(url, json.dumps(payload),
+                       content_type='application/json')
+
+
+def run(config, user, process_images=None, log=None):
+    """
+    Runs the scenarios as user and returns the report. process_images is
+    called between the ingest and the download scenarios to process the
+    queued images, like the background worker would.
+    """
+    log = log or (lambda msg: None)
+    factory = PayloadFactory(config)
+    client = Client()
+    client.force_login(user)
+    # The ids of the runs differ, but fit the ext_id column
+    prefix = u'B{}'.format(_base36(int(time.time())))
+    max_length = WorkItemTicket._meta.get_field('ext_id').max_length
+    assert len(u'{}T{:05d}'.format(prefix, config.tickets)) <= max_length, \
+        u'Too many tickets for the ext_id column'
+    scenarios = []
+
+    def scenario(name):
+        scenarios.append(Scenario(name))
+        log(u'{}...'.format(name))
+        return scenarios[-1]
+
+    # The payloads are generated before the timed requests
+    current = scenario('create_ticket')
+    ext_ids = [u'{}T{:05d}'.format(prefix, idx)
+               for idx in range(config.tickets)]
+    for ext_id in ext_ids:
+        payload = factory.ticket(ext_id)
+        current.measure(lambda: _post(client, '/api/v1/ticket/create',
+                                      payload))
+
+    current = scenario('create_uninstall_ticket')
+    for idx in range(config.tickets):
+        payload = factory.ticket(u'{}U{:05d}'.format(prefix, idx))
+        current.measure(lambda: _post(
+            client, '/api/v1/uninstall_ticket/create', payload))
+
+    current = scenario('add_ticket_attachment')
+    for idx, ext_id in enumerate(ext_ids):
+        payload = factory.attachment(ext_id, idx)
+        current.measure(lambda: _post(client, '/api/v1/ticket/attachment',
+                                      payload))
+
+    if process_images:
+        process_images()
+
+    ticket_ids = list(Ticket.objects.filter(ext_id__in=ext_ids)
+                      .values_list('pk', flat=True))
+    attachments = list(Attachment.objects.filter(ticket__in=ticket_ids)
+                       .values_list('pk', 'ticket_id'))
+    picked = [factory.random.choice(attachments)
+              for _ in range(config.downloads)] if attachments else []
+
+    for name, url in (('download_attachment', '/api/v1/attachment/{}'),
+                      ('download_thumbnail', '/api/v1/thumbnail/{}')):
+        current = scenario(name)
+        for pk, _ in picked:
+            current.measure(lambda: client.get(url.format(pk)))
+
+    current = scenario('download_thumbnails')
+    for _, ticket_id in picked:
+        current.measure(lambda: client.get(
+            '/api/v1/thumbnails/{}'.format(ticket_id)))
+
+    return {
+        'created_at': datetime.datetime.now().isoformat(),
+        'database': connection.vendor,
+        'config': config.as_dict(),
+        'scenarios': dict((s.name, s.summary()) for s in scenarios),
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+
+def compare(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Returns the regressions of the report against a baseline report as
+    (scenario, metric, baseline value, current value) tuples
+    """
+    regressions = []
+    # Higher is worse for all of these
+    metrics = ('p50_ms', 'p95_ms', 'queries_avg', 'queries_max')
+    for name, current in sorted(report['scenarios'].iteritems()):
+        previous = baseline['scenarios'].get(name)
+        if not previous:
+            continue
+        for metric in metrics:
+            old, new = previous.get(metric), current.get(metric)
+            if old is None or new is None:
+                continue
+            # The query counts are deterministic, any increase counts
+            limit = old if metric.startswith('queries') \
+                else old * (1 + tolerance)
+            if new > limit:
+                regressions.append((name, metric, old, new))
+        if current['errors'] > previous['errors']:
+            regressions.append((name, 'errors', previous['errors'],
+                                current['errors']))
+
+    old_rss, new_rss = baseline.get('peak_rss_kb'), report['peak_rss_kb']
+    if old_rss and new_rss > old_rss * (1 + tolerance):
+        regressions.append((None, 'peak_rss_kb', old_rss, new_rss))
+    return regressions
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import hashlib
+import tempfile
+
+from django.utils.module_loading import import_string
+
+from rovidtav import settings
+
+
+class BlobNotFound(Exception):
+    pass
+
+
+class BaseBlobStore(object):
+    """
+    Content addressed storage for the attachment payloads. Every blob is
+    identified by the hex SHA-256 digest of its content.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def put(self, data):
+        """
+        Stores the raw bytes and returns a (hash, size) tuple
+        """
+        raise NotImplementedError
+
+    def put_file(self, fileobj):
+        """
+        Stores the content of a file-like object, returns a (hash, size)
+        tuple
+        """
+        return self.put(fileobj.read())
+
+    def open(self, blob_hash):
+        """
+        Returns a file-like object for reading the blob. Raises BlobNotFound
+        if the blob does not exist
+        """
+        raise NotImplementedError
+
+    def exists(self, blob_hash):
+        raise NotImplementedError
+
+    def delete(self, blob_hash):
+        raise NotImplementedError
+
+    def iter_chunks(self, blob_hash, chunk_size=None):
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        with self.open(blob_hash) as blob:
+            while True:
+                chunk = blob.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+
+class FileSystemBlobStore(BaseBlobStore):
+    """
+    Stores the blobs in a local directory tree, fanned out by the first
+    two bytes of the hash: <root>/ab/cd/abcd...
+    """
+
+    def __init__(self, root=None):
+        self.root = root or settings.BLOB_STORE_ROOT
+
+    def path(self, blob_hash):
+        return os.path.join(self.root, blob_hash[:2], blob_hash[2:4],
+                            blob_hash)
+
+    def put(self, data):
+        blob_hash = hashlib.sha256(data).hexdigest()
+        path = self.path(blob_hash)
+        if not os.path.exists(path):
+            directory = os.path.dirname(path)
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            # Write to a temp file first, so a concurrent reader never sees
+            # a partially written blob
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as tmp:
+                    tmp.write(data)
+                os.rename(tmp_path, path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        return blob_hash, len(data)
+
+    def put_file(self, fileobj):
+        # The content is hashed while it is copied, it is never held in
+        # memory as a whole
+        try:
+            os.makedirs(self.root)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                while True:
+                    chunk = fileobj.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    size += len(chunk)
+                    tmp.write(chunk)
+            blob_hash = digest.hexdigest()
+            path = self.path(blob_hash)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return blob_hash, size
+
+    def open(self, blob_hash):
+        try:
+            return open(self.path(blob_hash), 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise BlobNotFound(blob_hash)
+            raise
+
+    def exists(self, blob_hash):
+        return os.path.exists(self.path(blob_hash))
+
+    def delete(self, blob_hash):
+        try:
+            os.remove(self.path(blob_hash))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+_blob_store = None
+
+
+def get_blob_store():
+    """
+    Returns the configured blob store backend (BLOB_STORE_BACKEND setting)
+    """
+    global _blob_store
+    if _blob_store is None:
+        backend = getattr(settings, 'BLOB_STORE_BACKEND',
+                          'rovidtav.blobstore.FileSystemBlobStore')
+        _blob_store = import_string(backend)()
+    return _blob_store
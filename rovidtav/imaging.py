@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import StringIO
+
+from PIL import Image, ExifTags
+
+ORIENTATION_TAG = next(k for k, v in ExifTags.TAGS.items()
+                       if v == 'Orientation')
+
+
+def exif_orientation(img):
+    try:
+        raw_exif = img._getexif() or {}
+    except AttributeError:
+        raw_exif = {}
+    return raw_exif.get(ORIENTATION_TAG)
+
+
+def orient(img):
+    """
+    Applies the EXIF Orientation 6/8 rotation on the image. Returns the
+    image and a flag telling if the image has been rotated
+    """
+    orientation = exif_orientation(img)
+    if orientation == 6:
+        return img.rotate(-90, expand=True), True
+    elif orientation == 8:
+        return img.rotate(90, expand=True), True
+    return img, False
+
+
+def render(fileobj, name, pixels=None):
+    """
+    Returns the image bytes with the EXIF orientation applied, optionally
+    shrunk to fit into pixels x pixels. The name defines the output format.
+    """
+    img = Image.open(fileobj)
+    img.load()
+    if pixels:
+        img.thumbnail((pixels, pixels), Image.ANTIALIAS)
+    img, _ = orient(img)
+    temp_buff = StringIO.StringIO()
+    temp_buff.name = name
+    img.save(temp_buff)
+    temp_buff.seek(0)
+    return temp_buff.read()
@@ -0,0 +1,655 @@
+# -*- coding: utf-8 -*-
+
+import json
+import hashlib
+import datetime
+import traceback
+from collections import OrderedDict, defaultdict
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.utils import IntegrityError
+from django.utils import timezone
+
+from rovidtav import refcache, jsonstream
+from rovidtav.api.field_const import Fields
+from rovidtav.models import (
+    Client, Ticket, Note, Device, DeviceOwner, Const, Attachment,
+    UninstallTicket, UninstAttachment, IngestJob)
+
+
+class IngestError(Exception):
+
+    def __init__(self, error, ticket_id=None):
+        super(IngestError, self).__init__(error)
+        # The existing ticket of a duplicate payload
+        self.ticket_id = ticket_id
+
+
+class IngestRefs(object):
+    """
+    Lookups of the rows referred by the ticket payloads. The reference
+    tables (cities, types, tags) are served by the process-local refcache.
+    By default the rest of the lookups hit the database, prefetch() loads
+    everything a batch of payloads refers to with one query per model. The
+    notes and device owners are collected and inserted in bulk by flush().
+    """
+
+    def __init__(self, ticket_cls):
+        self.ticket_cls = ticket_cls
+        self.prefetched = False
+        self.ext_ids = {}
+        # Match key -> client, the keys not in client_keys are looked up
+        # in the database
+        self.clients = {}
+        self.client_keys = set()
+        self.devices = {}
+        # The serial numbers are compared case insensitively by some
+        # database collations
+        self.folded_sns = set()
+        self.notes = []
+        self.owners = []
+        self._undo = []
+
+    def prefetch(self, payloads):
+        ext_ids, client_keys, sns = set(), set(), set()
+        for data in payloads:
+            ext_ids.add(data.get(Fields.TICKET_ID))
+            client_keys.add(self._client_key(data))
+            for device in data.get(Fields.DEVICES) or []:
+                sns.add(device.get(Fields.DEV_SN))
+        ext_ids.discard(None)
+        client_keys.discard(None)
+        sns.discard(None)
+
+        self.ext_ids = dict(
+            self.ticket_cls.objects.filter(ext_id__in=ext_ids)
+            .values_list('ext_id', 'pk'))
+        for client in Client.objects.filter(match_key__in=client_keys) \
+                .order_by('pk'):
+            self.clients.setdefault(client.match_key, client)
+        self.client_keys = client_keys
+        for dev in Device.objects.filter(sn__in=sns):
+            self.devices.setdefault(dev.sn, []).append(dev)
+            self.folded_sns.add(dev.sn.lower())
+        self.prefetched = True
+
+    @staticmethod
+    def _client_key(data):
+        """
+        The match key of the client of a payload, None if the city is not
+        known yet (there is no client in it then)
+        """
+        try:
+            city = refcache.cities.get(name=data[Fields.CITY],
+                                       zip=int(data[Fields.ZIP]))
+        except (KeyError, TypeError, ValueError):
+            return None
+        if city is None:
+            return None
+        return Client.make_match_key(
+            str(data.get(Fields.FLIP_ID) or data.get(Fields.MT_ID)), city.pk,
+            data.get(Fields.NAME1))
+
+    def _get_or_create(self, cache, **kwargs):
+        obj, created = cache.get_or_create(**kwargs)
+        if created:
+            self._undo.append(cache.invalidate)
+        return obj
+
+    def _append(self, cache, key, obj):
+        cache.setdefault(key, []).append(obj)
+        self._undo.append(lambda: cache[key].remove(obj))
+
+    def savepoint(self):
+        self._undo = []
+        return len(self.notes), len(self.owners)
+
+    def rollback(self, savepoint):
+        """
+        Forgets the rows created since the savepoint
+        """
+        notes, owners = savepoint
+        del self.notes[notes:]
+        del self.owners[owners:]
+        for undo in reversed(self._undo):
+            undo()
+        self._undo = []
+
+    def existing_ticket(self, ext_id):
+        """
+        Returns the id of the ticket with the ext_id or None
+        """
+        if not self.prefetched:
+            return self.ticket_cls.objects.filter(ext_id=ext_id) \
+                .values_list('pk', flat=True).first()
+        return self.ext_ids.get(ext_id)
+
+    def add_ticket(self, ticket):
+        ext_id = ticket.ext_id
+        self.ext_ids[ext_id] = ticket.pk
+        self._undo.append(lambda: self.ext_ids.pop(ext_id, None))
+
+    def city(self, name, zip):
+        return self._get_or_create(refcache.cities, name=name, zip=zip)
+
+    def ticket_type(self, name):
+        return self._get_or_create(refcache.ticket_types, name=name)
+
+    def tag(self, name):
+        return self._get_or_create(refcache.tags, name=name)
+
+    def device_type(self, name):
+        return self._get_or_create(refcache.device_types, name=name)
+
+    def client(self, mt_id, city, name):
+        """
+        Returns the oldest client with the match key of the mt_id, city and
+        name, or None
+        """
+        key = Client.make_match_key(mt_id, city.pk, name)
+        if key in self.clients or key in self.client_keys:
+            return self.clients.get(key)
+        return Client.objects.filter(match_key=key).order_by('pk').first()
+
+    def add_client(self, client):
+        if self.prefetched:
+            key = client.match_key
+            self.clients.setdefault(key, client)
+            self._undo.append(lambda: self.clients.pop(key, None))
+
+    def devices_by_sns(self, sns):
+        """
+        Returns the existing devices of the serial numbers, ordered by pk,
+        with one query at most
+        """
+        found = {}
+        missing = {}
+        for sn in sns:
+            if self.prefetched and (sn in self.devices or
+                                    sn.lower() not in self.folded_sns):
+                found[sn] = list(self.devices.get(sn, []))
+            else:
+                found[sn] = []
+                missing[sn.lower()] = sn
+        if missing:
+            for dev in Device.objects.filter(sn__in=missing.values()) \
+                    .order_by('pk'):
+                # Some collations match regardless of the case
+                sn = dev.sn if dev.sn in found else missing[dev.sn.lower()]
+                found[sn].append(dev)
+        return found
+
+    def add_device(self, device):
+        if self.prefetched:
+            self._append(self.devices, device.sn, device)
+
+    def change_device(self, device, **values):
+        """
+        Updates the attributes of a cached device, restored on rollback
+        """
+        previous = dict((key, getattr(device, key)) for key in values)
+        for key, value in values.items():
+            setattr(device, key, value)
+        self._undo.append(lambda: [setattr(device, key, value)
+                                   for key, value in previous.items()])
+
+    def flush(self):
+        Note.objects.bulk_create(self.notes)
+        DeviceOwner.objects.bulk_create(self.owners)
+        self.notes = []
+        self.owners = []
+
+
+def _content(value, encode=False):
+    """
+    Attachment kwargs of a payload value, which may have been spilled into
+    a file by jsonstream
+    """
+    if hasattr(value, 'read'):
+        return {'payload_file': value}
+    return {'_data': value.encode('utf-8') if encode else value}
+
+
+def _pick_device(devices):
+    """
+    Chooses one of the devices registered with the same serial number: the
+    latest one still in use, or the latest one if all have been returned
+    """
+    in_use = [dev for dev in devices if dev.returned_at is None]
+    return max(in_use or devices, key=lambda dev: dev.pk)
+
+
+def _reconcile_devices(ticket, devices_data, client, client_ct, refs):
+    """
+    Brings the devices listed in the payload to the requested state with
+    a fixed number of queries: one lookup, one UPDATE per changed status,
+    one UPDATE for the uninstall ticket links and one bulk INSERT. A serial
+    number listed more than once gets the state of its last entry.
+    """
+    wanted = OrderedDict()
+    for device in devices_data:
+        if device.get(Fields.DEV_ACTION) == u'Leszerelendő':
+            status = Const.DeviceStatus.TO_UNINSTALL
+        else:
+            status = Const.DeviceStatus.ACTIVE
+        wanted[device[Fields.DEV_SN]] = (status, device.get(Fields.DEV_TYPE))
+
+    uninstall = isinstance(ticket, UninstallTicket)
+    existing = refs.devices_by_sns(wanted.keys())
+    status_changes = defaultdict(list)
+    relinked = []
+    new_devices = []
+    ticket_ct = ticket.get_content_type_obj()
+    for sn, (status, dev_type) in wanted.items():
+        devices = existing[sn]
+        if not devices:
+            new_devices.append(Device(
+                sn=sn,
+                type=refs.device_type((dev_type or '').strip()),
+                status=status,
+                uninstall_ticket=ticket if uninstall else None,
+            ))
+            continue
+
+        dev = _pick_device(devices)
+        if len(devices) > 1:
+            refs.notes.append(Note(
+                content_type=ticket_ct,
+                object_id=ticket.pk,
+                is_history=True,
+                remark=u'{} eszköz a {} vonalkóddal, a #{} eszköz '
+                       u'használva'.format(len(devices), sn, dev.pk),
+                created_by=ticket.created_by,
+            ))
+        if dev.status != status:
+            status_changes[status].append(dev)
+        if uninstall and dev.uninstall_ticket_id != ticket.pk:
+            relinked.append(dev)
+
+    for status, devices in status_changes.items():
+        # Same as Device.save for the active statuses
+        Device.objects.filter(pk__in=[changed.pk for changed in devices]) \
+            .update(status=status, returned_at=None)
+        for dev in devices:
+            refs.change_device(dev, status=status, returned_at=None)
+    if relinked:
+        Device.objects.filter(pk__in=[changed.pk for changed in relinked]) \
+            .update(uninstall_ticket=ticket)
+        for dev in relinked:
+            refs.change_device(dev, uninstall_ticket_id=ticket.pk)
+
+    if new_devices:
+        Device.objects.bulk_create(new_devices)
+        if any(dev.pk is None for dev in new_devices):
+            # The database backend does not return the new ids
+            created = dict((dev.sn, dev) for dev in Device.objects.filter(
+                sn__in=[new.sn for new in new_devices]).order_by('pk'))
+            new_devices = [created[new.sn] for new in new_devices]
+        for dev in new_devices:
+            refs.add_device(dev)
+            refs.owners.append(DeviceOwner(device=dev,
+                                           content_type=client_ct,
+                                           object_id=client.pk))
+
+
+def ingest_ticket(ticket_cls, attachment_cls, data, user, refs,
+                  assignee=None):
+    """
+    Creates a ticket from an email parser payload. Raises IngestError if
+    the payload is not acceptable. assignee returns the owner of the new
+    ticket for its city or None.
+    """
+    req_keys = (Fields.CITY, Fields.ZIP, Fields.STREET, Fields.HOUSE_NUM,
+                Fields.NAME1, Fields.MT_ID, Fields.TASK_TYPE, Fields.TICKET_ID,
+                )  # Fields.PHONE1)
+
+    if not all(key in data for key in req_keys):
+        missing_keys = list(set(req_keys) - set(data.keys()))
+        raise IngestError({'missing_keys': missing_keys})
+
+    ext_id = data[Fields.TICKET_ID]
+    existing = refs.existing_ticket(ext_id)
+    if existing:
+        raise IngestError('duplicate ticket: {}'.format(ext_id), existing)
+
+    if Fields.AGREED_TIME_FROM in data and data[Fields.AGREED_TIME_FROM]:
+        try:
+            time_fmt = '%Y-%m-%d %H:%M:%S'
+            time_from_raw = data[Fields.AGREED_TIME_FROM]
+            time_from = datetime.datetime.strptime(time_from_raw, time_fmt)
+            time_to_raw = data.get(Fields.AGREED_TIME_TO)
+            time_to = None
+            if time_to_raw:
+                time_to = datetime.datetime.strptime(time_to_raw, time_fmt)
+        except Exception:
+            raise IngestError('Error interpreting agreed times'
+                              ' FROM {} TO {}'
+                              ''.format(data[Fields.AGREED_TIME_FROM],
+                                        data.get(Fields.AGREED_TIME_TO)))
+    else:
+        time_from = None
+        time_to = None
+
+    city = refs.city(data[Fields.CITY], int(data[Fields.ZIP]))
+
+    mt_id = str(data.get(Fields.FLIP_ID) or data.get(Fields.MT_ID))
+    addr = u'{} {}'.format(data[Fields.STREET],
+                           data[Fields.HOUSE_NUM])
+
+    client = refs.client(mt_id, city, data[Fields.NAME1])
+    if client is None:
+        phone1 = data.get(Fields.PHONE1, u'')
+        phone2 = data.get(Fields.PHONE2, u'')
+        if phone1 and phone2:
+            phone = '{}, {}'.format(phone1, phone2)
+        else:
+            phone = phone1 or phone2
+        client = Client.objects.create(
+            mt_id=mt_id,
+            name=data[Fields.NAME1],
+            city=city,
+            address=addr,
+            phone=phone,
+            created_by=user,
+        )
+        refs.add_client(client)
+
+    ticket_types = [refs.ticket_type(t) for t in
+                    data.get(Fields.TASK_TYPE_LIST) or
+                    [data[Fields.TASK_TYPE]]]
+
+    # Everything known up front is set before the insert, the ticket is
+    # not saved again
+    fields = {}
+    if not hasattr(ticket_cls, 'ticket_types'):
+        fields['ticket_type'] = ticket_types[0]
+    owner = assignee(city) if assignee else None
+    if owner:
+        fields.update(owner=owner, status=Const.TicketStatus.ASSIGNED)
+
+    try:
+        with transaction.atomic():
+            ticket = ticket_cls.objects.create(
+                ext_id=ext_id,
+                client=client,
+                city=city,
+                address=addr,
+                created_by=user,
+                created_at=data['mail_date'],
+                agreed_time_from=time_from,
+                agreed_time_to=time_to,
+                **fields
+            )
+    except IntegrityError:
+        # Created by a concurrent request, ext_id is unique
+        existing = ticket_cls.objects.filter(ext_id=ext_id) \
+            .values_list('pk', flat=True).first()
+        if existing is None:
+            raise
+        raise IngestError('duplicate ticket: {}'.format(ext_id), existing)
+    refs.add_ticket(ticket)
+
+    if 'ticket_type' not in fields:
+        ticket.ticket_types.add(*ticket_types)
+
+    client_ct = client.get_content_type_obj()
+    tags = []
+    if Fields.EXTRA_DEVICES in data and data[Fields.EXTRA_DEVICES]:
+        tags.append(refs.tag(u'Extra eszköz'))
+        for device in data[Fields.EXTRA_DEVICES]:
+            tags.append(refs.tag(device[Fields.EXTRA_DEV_CODE]))
+            tags.append(refs.tag(device[Fields.EXTRA_DEV_TYPE]))
+            dt = refs.device_type(device[Fields.EXTRA_DEV_CODE])
+            dev = Device.objects.create(type=dt, sn=u'NINCS KITÖLTVE')
+            refs.owners.append(DeviceOwner(device=dev,
+                                           content_type=client_ct,
+                                           object_id=client.pk))
+
+    if data.get(Fields.FLIP_ID):
+        tags.append(refs.tag(u'Flip'))
+
+    if tags:
+        ticket.ticket_tags.add(*tags)
+
+    ticket_ct = ticket.get_content_type_obj()
+    if owner:
+        refs.notes.extend(assignment_notes(ticket_ct, ticket.pk, owner, user))
+
+    if Fields.REMARKS in data and data[Fields.REMARKS]:
+        refs.notes.append(Note(
+            content_type=ticket_ct,
+            object_id=ticket.pk,
+            is_history=False,
+            remark=data[Fields.REMARKS],
+            created_by=user,
+        ))
+
+    if Fields.COLLECTABLE_MONEY in data and data[Fields.COLLECTABLE_MONEY]:
+        refs.notes.append(Note(
+            content_type=ticket_ct,
+            object_id=ticket.pk,
+            is_history=False,
+            remark=u'Beszedés {}'.format(data[Fields.COLLECTABLE_MONEY]),
+            created_by=user,
+        ))
+        ticket[Ticket.Keys.COLLECTABLE_MONEY] = data[Fields.COLLECTABLE_MONEY]
+
+    if Fields.DEVICES in data:
+        _reconcile_devices(ticket, data[Fields.DEVICES], client, client_ct,
+                           refs)
+
+    if 'html' in data:
+        attachment_cls.objects.create(
+            ticket=ticket,
+            name='Hibajegy.html',
+            remark=u'A matávtól érkezett eredeti hibajegy',
+            created_by=user,
+            **_content(data['html'], encode=True)
+        )
+
+    for att_name, att_content in data['attachments'].iteritems():
+        attachment_cls.objects.create(
+            ticket=ticket,
+            name=att_name,
+            created_by=user,
+            **_content(att_content)
+        )
+
+    return ticket
+
+
+def uninstall_assignee(city):
+    """
+    The technician of the uninstall ticket rule of the primer of the city
+    """
+    rule = refcache.uninstall_rules.get(primer=city.primer)
+    return rule.assign_to if rule else None
+
+
+def assignment_notes(ticket_ct, ticket_pk, owner, user):
+    """
+    The history notes BaseTicket.save creates when a new ticket is assigned
+    """
+    remarks = (
+        u'Új tulajdonos: {} >> {}'.format(Const.NO_OWNER, owner.username),
+        u'Státusz változás: {} >> {}'.format(Const.TicketStatus.NEW,
+                                             Const.TicketStatus.ASSIGNED),
+    )
+    return [Note(content_type=ticket_ct, object_id=ticket_pk,
+                 is_history=True, remark=remark, created_by=user)
+            for remark in remarks]
+
+
+def ingest_attachment(data, user):
+    req_keys = (Fields.TICKET_ID, 'attachment_name', 'attachment_content')
+    if not all(key in data for key in req_keys):
+        missing_keys = list(set(req_keys) - set(data.keys()))
+        raise IngestError({'missing_keys': missing_keys})
+
+    try:
+        ticket = Ticket.objects.get(ext_id=data['ticket_id'])
+    except Ticket.DoesNotExist:
+        raise IngestError('Ticket {} does not exist'
+                          ''.format(data['ticket_id']))
+
+    return Attachment.objects.create(
+        ticket=ticket,
+        name=data['attachment_name'],
+        created_by=user,
+        **_content(data['attachment_content'])
+    )
+
+
+def ingest_attachments(data, user):
+    """
+    Appends a list of attachments to one or more tickets. All of them are
+    stored or none, the tickets are looked up with one query and their
+    has_images flag is refreshed once.
+    """
+    items = data.get('attachments')
+    if not isinstance(items, list):
+        raise IngestError('a list of attachments expected')
+    req_keys = (Fields.TICKET_ID, 'attachment_name', 'attachment_content')
+    for item in items:
+        if not all(key in item for key in req_keys):
+            missing_keys = list(set(req_keys) - set(item.keys()))
+            raise IngestError({'missing_keys': missing_keys})
+
+    ext_ids = set(unicode(item[Fields.TICKET_ID]) for item in items)
+    tickets = dict(Ticket.objects.filter(ext_id__in=ext_ids)
+                   .values_list('ext_id', 'pk'))
+    missing = sorted(ext_ids - set(tickets))
+    if missing:
+        raise IngestError('Ticket {} does not exist'
+                          ''.format(', '.join(missing)))
+
+    attachment_ids = []
+    image_tickets = set()
+    with transaction.atomic():
+        for item in items:
+            att = Attachment(
+                ticket_id=tickets[unicode(item[Fields.TICKET_ID])],
+                name=item['attachment_name'],
+                created_by=user,
+                **_content(item['attachment_content'])
+            )
+            att.save(update_has_images=False)
+            attachment_ids.append(att.pk)
+            if att.counts_as_image():
+                image_tickets.add(att.ticket_id)
+        Ticket.objects.filter(pk__in=image_tickets, has_images=False) \
+            .update(has_images=True)
+    return attachment_ids
+
+
+# The large values of the payloads, spilled into temporary files by the
+# streaming parser
+SPILL = {
+    IngestJob.TICKET: {'html': jsonstream.TEXT,
+                       'attachments': {'*': jsonstream.BASE64}},
+    IngestJob.UNINSTALL_TICKET: {'html': jsonstream.TEXT,
+                                 'attachments': {'*': jsonstream.BASE64}},
+    IngestJob.TICKET_ATTACHMENT: {'attachment_content': jsonstream.BASE64},
+    IngestJob.TICKET_ATTACHMENTS: {
+        'attachments': [{'attachment_content': jsonstream.BASE64}]},
+}
+
+# The ticket classes, attachment classes and assignees of the ticket
+# create payloads
+TICKET_KINDS = {
+    IngestJob.TICKET: (Ticket, Attachment, None),
+    IngestJob.UNINSTALL_TICKET: (UninstallTicket, UninstAttachment,
+                                 uninstall_assignee),
+}
+
+
+def process(kind, data, user):
+    """
+    Processes a create payload, returns the response data. Raises
+    IngestError if the payload is not acceptable.
+    """
+    if kind == IngestJob.TICKET_ATTACHMENT:
+        ingest_attachment(data, user)
+        return {'OK': 'Done'}
+    if kind == IngestJob.TICKET_ATTACHMENTS:
+        return {'attachment_ids': ingest_attachments(data, user)}
+
+    ticket_cls, attachment_cls, assignee = TICKET_KINDS[kind]
+    refs = IngestRefs(ticket_cls)
+    ticket = ingest_ticket(ticket_cls, attachment_cls, data, user, refs,
+                           assignee)
+    refs.flush()
+    return {'ticket_id': ticket.pk}
+
+
+def enqueue(kind, payload, user, key=None):
+    """
+    Stores the raw payload for the process_ingest_queue command. The job
+    is identified by the hash of the kind and the explicit key, or the
+    payload without one. Posting a payload again returns the existing job,
+    a failed one is queued again. Returns (job, created).
+    """
+    if key:
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        ident = 'key\n' + key
+    else:
+        ident = 'payload\n' + payload
+    key = hashlib.sha256(kind + '\n' + ident).hexdigest()
+    try:
+        with transaction.atomic():
+            return IngestJob.objects.create(kind=kind, key=key,
+                                            payload=payload,
+                                            created_by=user), True
+    except IntegrityError:
+        job = IngestJob.objects.get(key=key)
+    if job.status == Const.JobStatus.ERROR:
+        IngestJob.objects.filter(pk=job.pk, status=Const.JobStatus.ERROR) \
+            .update(status=Const.JobStatus.NEW)
+        job.refresh_from_db()
+    return job, False
+
+
+def requeue_stale(seconds):
+    """
+    Queues the jobs again which have been in progress for too long, their
+    worker has probably died
+    """
+    limit = timezone.now() - datetime.timedelta(seconds=seconds)
+    return IngestJob.objects.filter(status=Const.JobStatus.IN_PROGRESS,
+                                    started_at__lt=limit) \
+        .update(status=Const.JobStatus.NEW)
+
+
+def run_job(pk):
+    """
+    Processes a queued job in a transaction, nothing is left behind by a
+    failed attempt so it can be retried safely. Returns True on success.
+    """
+    claimed = IngestJob.objects.filter(pk=pk, status=Const.JobStatus.NEW) \
+        .update(status=Const.JobStatus.IN_PROGRESS,
+                started_at=timezone.now())
+    if not claimed:
+        # Taken by another worker
+        return False
+
+    job = IngestJob.objects.get(pk=pk)
+    result = error = None
+    try:
+        with transaction.atomic():
+            result = process(job.kind, json.loads(job.payload),
+                             User.objects.get(pk=job.created_by_id))
+    except IngestError as e:
+        error = e.args[0]
+    except Exception:
+        error = traceback.format_exc()
+
+    IngestJob.objects.filter(pk=pk).update(
+        status=Const.JobStatus.ERROR if error else Const.JobStatus.DONE,
+        attempts=job.attempts + 1,
+        result=json.dumps(result) if result else None,
+        error=json.dumps(error) if error else None,
+        finished_at=timezone.now(),
+    )
+    return error is None
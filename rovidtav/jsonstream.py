@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+"""
+Incremental JSON parser for the large API payloads. The selected string
+values are not kept in memory, they are spilled into temporary files while
+the request body is read.
+"""
+
+import re
+import json
+import binascii
+import tempfile
+
+# Spill modes: the string is written as it is (utf-8) or base64 decoded
+TEXT = 'text'
+BASE64 = 'base64'
+
+# Spilled values above this size are moved from memory to the disk
+SPOOL_MAX_SIZE = 1024 * 1024
+
+_STRING_SPECIAL = re.compile(r'["\\]')
+_NON_WS = re.compile(r'[^ \t\r\n]')
+_SCALAR_CHARS = frozenset('-+0123456789.eEtruefalsn')
+_NON_BASE64 = re.compile(r'[^A-Za-z0-9+/=]')
+_ESCAPES = {
+    '"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n',
+    'r': '\r', 't': '\t',
+}
+
+
+class _Base64Writer(object):
+    """
+    Decodes the base64 text written into it in 4 character blocks
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.pending = ''
+
+    def write(self, text):
+        text = self.pending + _NON_BASE64.sub('', text)
+        cut = len(text) - len(text) % 4
+        self.pending = text[cut:]
+        if cut:
+            self.fileobj.write(self._decode(text[:cut]))
+
+    def close(self):
+        if self.pending:
+            self.fileobj.write(self._decode(self.pending))
+            self.pending = ''
+
+    @staticmethod
+    def _decode(text):
+        try:
+            return binascii.a2b_base64(text)
+        except binascii.Error as e:
+            raise ValueError(u'Invalid base64 content: {}'.format(e))
+
+
+class _Parser(object):
+
+    def __init__(self, fileobj, chunk_size=64 * 1024):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+
+    def _fill(self):
+        if self.pos >= len(self.buf):
+            self.buf = self.fileobj.read(self.chunk_size)
+            self.pos = 0
+        return bool(self.buf)
+
+    def peek(self):
+        if not self._fill():
+            raise ValueError('Unexpected end of JSON data')
+        return self.buf[self.pos]
+
+    def take(self):
+        char = self.peek()
+        self.pos += 1
+        return char
+
+    def skip_ws(self):
+        while self._fill():
+            match = _NON_WS.search(self.buf, self.pos)
+            if match:
+                self.pos = match.start()
+                return
+            self.pos = len(self.buf)
+
+    def at_end(self):
+        self.skip_ws()
+        return not self._fill()
+
+    def expect(self, char):
+        self.skip_ws()
+        found = self.take()
+        if found != char:
+            raise ValueError('Expecting {!r} instead of {!r}'
+                             ''.format(char, found))
+
+    def read_string(self, write):
+        """
+        Reads a string after its opening quote, the unescaped content is
+        passed to write in utf-8 encoded pieces
+        """
+        while True:
+            if not self._fill():
+                raise ValueError('Unterminated string')
+            match = _STRING_SPECIAL.search(self.buf, self.pos)
+            if match is None:
+                write(self.buf[self.pos:])
+                self.pos = len(self.buf)
+                continue
+            if match.start() > self.pos:
+                write(self.buf[self.pos:match.start()])
+            self.pos = match.end()
+            if match.group() == '"':
+                return
+            write(self._escape())
+
+    def _escape(self):
+        char = self.take()
+        if char in _ESCAPES:
+            return _ESCAPES[char]
+        if char != 'u':
+            raise ValueError('Invalid escape \\{}'.format(char))
+        code = int(''.join(self.take() for _ in range(4)), 16)
+        if 0xd800 <= code < 0xdc00:
+            # Surrogate pair
+            self.expect('\\')
+            self.expect('u')
+            low = int(''.join(self.take() for _ in range(4)), 16)
+            code = 0x10000 + ((code - 0xd800) << 10) + (low - 0xdc00)
+        return ('\\U{:08x}'.format(code)).decode('unicode-escape') \
+            .encode('utf-8')
+
+    def value(self, spill=None):
+        self.skip_ws()
+        char = self.peek()
+        if char == '"':
+            self.take()
+            if spill in (TEXT, BASE64):
+                return self._spill_string(spill)
+            parts = []
+            self.read_string(parts.append)
+            return ''.join(parts).decode('utf-8')
+        if char == '{':
+            return self._object(spill if isinstance(spill, dict) else None)
+        if char == '[':
+            return self._array(spill[0] if isinstance(spill, list) else None)
+        return self._scalar()
+
+    def _spill_string(self, mode):
+        spilled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        if mode == BASE64:
+            writer = _Base64Writer(spilled)
+            self.read_string(writer.write)
+            writer.close()
+        else:
+            self.read_string(spilled.write)
+        spilled.seek(0)
+        return spilled
+
+    def _object(self, spill):
+        self.take()
+        result = {}
+        self.skip_ws()
+        if self.peek() == '}':
+            self.take()
+            return result
+        while True:
+            self.expect('"')
+            parts = []
+            self.read_string(parts.append)
+            key = ''.join(parts).decode('utf-8')
+            self.expect(':')
+            mode = spill.get(key, spill.get('*')) if spill else None
+            result[key] = self.value(mode)
+            self.skip_ws()
+            char = self.take()
+            if char == '}':
+                return result
+            if char != ',':
+                raise ValueError('Expecting , or }} instead of {!r}'
+                                 ''.format(char))
+
+    def _array(self, spill):
+        self.take()
+        result = []
+        self.skip_ws()
+        if self.peek() == ']':
+            self.take()
+            return result
+        while True:
+            result.append(self.value(spill))
+            self.skip_ws()
+            char = self.take()
+            if char == ']':
+                return result
+            if char != ',':
+                raise ValueError('Expecting , or ] instead of {!r}'
+                                 ''.format(char))
+
+    def _scalar(self):
+        token = []
+        while self._fill() and self.buf[self.pos] in _SCALAR_CHARS:
+            token.append(self.buf[self.pos])
+            self.pos += 1
+        return json.loads(''.join(token))
+
+
+def load(fileobj, spill=None):
+    """
+    Parses a JSON object from a file-like object. spill maps the keys to
+    spill into a temporary file to TEXT or BASE64, a nested dict applies to
+    the members of an object value, '*' matches every key, e.g.
+    {'html': TEXT, 'attachments': {'*': BASE64}}. A list of one spec applies
+    it to every item of an array value, e.g. {'items': [{'data': BASE64}]}.
+    Spilled values are returned as file-like objects positioned at the
+    start.
+    """
+    parser = _Parser(fileobj)
+    result = parser.value(spill)
+    if not parser.at_end():
+        raise ValueError('Extra data after the JSON object')
+    if not isinstance(result, dict):
+        raise ValueError('JSON object expected')
+    return result
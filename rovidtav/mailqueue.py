@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+Outbound email queue. The messages are stored in SystemEmail rows and sent
+by the send_emails command over one SMTP connection per batch.
+"""
+
+import random
+import smtplib
+from datetime import timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+
+from rovidtav import settings
+from rovidtav.models import Const, SystemEmail
+
+# A claimed message is not picked up by another worker for this long
+CLAIM_SECONDS = 600
+
+
+def enqueue(mail_pk, msg):
+    """
+    Queues a MIME message for sending on the SystemEmail row mail_pk, the
+    recipient is the one of the row
+    """
+    SystemEmail.objects.filter(pk=mail_pk).update(
+        message=msg.as_string(), next_attempt_at=timezone.now())
+
+
+def backoff(attempts):
+    """
+    The delay before the next attempt after the given number of failed
+    ones: exponential with equal jitter, so the retries of the messages
+    failed together are spread out
+    """
+    delay = min(settings.EMAIL_QUEUE_BACKOFF_MAX,
+                settings.EMAIL_QUEUE_BACKOFF_BASE * 2 ** (attempts - 1))
+    return timedelta(seconds=delay / 2.0 + random.uniform(0, delay / 2.0))
+
+
+def _claim(batch_size):
+    """
+    Returns the due messages, moved out of the reach of the other workers
+    """
+    now = timezone.now()
+    due = SystemEmail.objects.filter(
+        status=Const.EmailStatus.IN_PROGRESS, message__isnull=False) \
+        .filter(Q(next_attempt_at__lte=now) | Q(next_attempt_at__isnull=True))
+    pks = list(due.order_by('pk').values_list('pk', flat=True)[:batch_size])
+    if not pks:
+        return []
+    lease = now + timedelta(seconds=CLAIM_SECONDS)
+    claimed = []
+    for pk in pks:
+        if due.filter(pk=pk).update(next_attempt_at=lease):
+            claimed.append(pk)
+    return list(SystemEmail.objects.filter(pk__in=claimed).order_by('pk'))
+
+
+def _rows(mail):
+    # The message and the assignments collected into it
+    return SystemEmail.objects.filter(Q(pk=mail.pk) | Q(digest=mail.pk))
+
+
+def _failed(mail, error):
+    attempts = mail.attempts + 1
+    if attempts >= settings.EMAIL_QUEUE_MAX_ATTEMPTS:
+        _rows(mail).update(
+            status=Const.EmailStatus.ERROR, attempts=attempts,
+            next_attempt_at=None, remark=unicode(error))
+    else:
+        _rows(mail).update(
+            attempts=attempts,
+            next_attempt_at=timezone.now() + backoff(attempts),
+            remark=u'Újrapróbálás: {}'.format(error))
+
+
+def _connect():
+    smtp = smtplib.SMTP_SSL(settings.SMTP_SERVER)
+    smtp.login(settings.SMTP_USER, settings.SMTP_PASS)
+    return smtp
+
+
+def send_pending(batch_size=100):
+    """
+    Sends the due messages over a single authenticated SMTP connection.
+    Returns the number of sent and failed messages.
+    """
+    mails = _claim(batch_size)
+    if not mails:
+        return 0, 0
+
+    try:
+        smtp = _connect()
+    except (smtplib.SMTPException, IOError) as e:
+        for mail in mails:
+            _failed(mail, e)
+        return 0, len(mails)
+
+    sent = failed = 0
+    try:
+        for mail in mails:
+            try:
+                try:
+                    smtp.sendmail(settings.EMAIL_SENDER, mail.recipient,
+                                  mail.message)
+                except smtplib.SMTPServerDisconnected:
+                    # Dropped by the server during a long batch
+                    smtp = _connect()
+                    smtp.sendmail(settings.EMAIL_SENDER, mail.recipient,
+                                  mail.message)
+            except (smtplib.SMTPException, IOError) as e:
+                _failed(mail, e)
+                failed += 1
+                continue
+            _rows(mail).update(
+                status=Const.EmailStatus.SENT, attempts=mail.attempts + 1,
+                next_attempt_at=None, sent_at=timezone.now(),
+                remark=u'Sikeresen elküldve neki: {}'.format(mail.recipient))
+            sent += 1
+    finally:
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, IOError):
+            pass
+    return sent, failed
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from rovidtav import refcache
+from rovidtav.ingest import assignment_notes
+from rovidtav.models import Const, Note, UninstallTicket
+
+
+class Command(BaseCommand):
+    help = (
+        'Assigns the new, unassigned uninstall tickets by the uninstall '
+        'ticket rules, with one update per technician.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', required=True,
+                            help='Username recorded in the history notes')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only report the assignments')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(u'No user {}'.format(options['user']))
+
+        by_owner = defaultdict(list)
+        for pk, primer in UninstallTicket.objects \
+                .filter(owner__isnull=True, status=Const.TicketStatus.NEW) \
+                .values_list('pk', 'city__primer'):
+            rule = refcache.uninstall_rules.get(primer=primer)
+            if rule:
+                by_owner[rule.assign_to].append(pk)
+
+        ticket_ct = ContentType.objects.get_for_model(UninstallTicket)
+        assigned = 0
+        for owner, pks in by_owner.iteritems():
+            self.stdout.write(u'{}: {} tickets'.format(owner.username,
+                                                       len(pks)))
+            if options['dry_run']:
+                continue
+            with transaction.atomic():
+                # Only the tickets still unassigned, the notes are written
+                # for those
+                pks = list(UninstallTicket.objects.select_for_update()
+                           .filter(pk__in=pks, owner__isnull=True,
+                                   status=Const.TicketStatus.NEW)
+                           .values_list('pk', flat=True))
+                UninstallTicket.objects.filter(pk__in=pks).update(
+                    owner=owner, status=Const.TicketStatus.ASSIGNED)
+                notes = []
+                for pk in pks:
+                    notes.extend(assignment_notes(ticket_ct, pk, owner, user))
+                Note.objects.bulk_create(notes)
+            assigned += len(pks)
+
+        self.stdout.write(u'{} tickets assigned'.format(assigned))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from rovidtav.models import Client
+
+
+class Command(BaseCommand):
+    help = (
+        'Fills the match key of the clients created before it was '
+        'introduced. The ticket ingest finds the clients by this key.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', default=False,
+                            help='Recompute the key of every client')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of clients updated per transaction')
+
+    def handle(self, *args, **options):
+        clients = Client.objects.order_by('pk')
+        if not options['all']:
+            clients = clients.filter(match_key__isnull=True)
+        total = clients.count()
+        self.stdout.write(u'{} clients to update'.format(total))
+
+        updated = 0
+        last_pk = 0
+        while True:
+            batch = list(clients.filter(pk__gt=last_pk)
+                         .values_list('pk', 'mt_id', 'city_id', 'name')
+                         [:options['batch_size']])
+            if not batch:
+                break
+            with transaction.atomic():
+                for pk, mt_id, city_id, name in batch:
+                    Client.objects.filter(pk=pk).update(
+                        match_key=Client.make_match_key(mt_id, city_id, name))
+            last_pk = batch[-1][0]
+            updated += len(batch)
+            self.stdout.write(u'{}/{}'.format(updated, total))
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import json
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (setup_test_environment,
+                               teardown_test_environment)
+
+from rovidtav import benchmark, blobstore, thumbnails
+from rovidtav.models import BaseAttachment
+from rovidtav.management.commands.process_attachments import _process_one
+
+
+def _process_images():
+    for cls in BaseAttachment.__subclasses__():
+        for pk in cls.objects.filter(processed=False) \
+                .values_list('pk', flat=True):
+            _process_one((cls._meta.label, pk))
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks the ticket ingest and the attachment download endpoints '
+        'with synthetic mail parser payloads. The requests are sent to a '
+        'test database created from the configured one (SQLite or '
+        'PostgreSQL), the blobs and thumbnails go to temporary directories.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tickets', type=int, default=50,
+                            help='Number of tickets (and uninstall tickets)')
+        parser.add_argument('--devices', type=int, default=2,
+                            help='Number of devices per ticket')
+        parser.add_argument('--ticket-types', type=int, default=1,
+                            help='Number of ticket types per ticket')
+        parser.add_argument('--attachments', type=int, default=1,
+                            help='Number of non-image attachments per ticket')
+        parser.add_argument('--attachment-size', type=int, default=64 * 1024,
+                            help='Size of the non-image attachments in bytes')
+        parser.add_argument('--images', type=int, default=1,
+                            help='Number of JPEG attachments per ticket')
+        parser.add_argument('--image-px', type=int, default=1600,
+                            help='Width of the JPEG attachments')
+        parser.add_argument('--downloads', type=int, default=50,
+                            help='Number of download requests per endpoint')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Seed of the payload generator')
+        parser.add_argument('--keepdb', action='store_true', default=False,
+                            help='Keep the test database between runs')
+        parser.add_argument('--save-baseline', metavar='PATH',
+                            help='Save the report as a JSON baseline')
+        parser.add_argument('--compare', metavar='PATH',
+                            help='Compare the report with a JSON baseline '
+                                 'and fail on regressions')
+        parser.add_argument('--tolerance', type=float,
+                            default=benchmark.DEFAULT_TOLERANCE,
+                            help='Allowed relative slowdown against the '
+                                 'baseline')
+
+    def handle(self, *args, **options):
+        config = benchmark.Config(
+            tickets=options['tickets'], devices=options['devices'],
+            ticket_types=options['ticket_types'],
+            attachments=options['attachments'],
+            attachment_size=options['attachment_size'],
+            images=options['images'], image_px=options['image_px'],
+            downloads=options['downloads'], seed=options['seed'])
+
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        report = self._run(config, options['keepdb'])
+        self._print(report)
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            self.stdout.write(u'Baseline saved to {}'
+                              u''.format(options['save_baseline']))
+
+        if baseline:
+            regressions = benchmark.compare(report, baseline,
+                                            options['tolerance'])
+            for name, metric, old, new in regressions:
+                self.stdout.write(u'REGRESSION {} {}: {:.1f} -> {:.1f}'
+                                  u''.format(name or u'-', metric, old, new))
+            if regressions:
+                raise CommandError(u'{} regressions against {}'.format(
+                    len(regressions), options['compare']))
+            self.stdout.write(u'No regressions against {}'
+                              u''.format(options['compare']))
+
+    def _run(self, config, keepdb):
+        tmp_dir = tempfile.mkdtemp(prefix='rovidtav_benchmark_')
+        blob_store = blobstore._blob_store
+        thumbnail_cache = thumbnails._thumbnail_cache
+        blobstore._blob_store = blobstore.FileSystemBlobStore(
+            root=tmp_dir + '/blobs')
+        thumbnails._thumbnail_cache = thumbnails.ThumbnailCache(
+            root=tmp_dir + '/thumbnails')
+
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           keepdb=keepdb)
+        try:
+            user, _ = User.objects.get_or_create(username='benchmark')
+            return benchmark.run(config, user,
+                                 process_images=_process_images,
+                                 log=self.stdout.write)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0,
+                                                keepdb=keepdb)
+            teardown_test_environment()
+            blobstore._blob_store = blob_store
+            thumbnails._thumbnail_cache = thumbnail_cache
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _print(self, report):
+        self.stdout.write(u'{:<26} {:>6} {:>6} {:>8} {:>9} {:>9} {:>8}'
+                          u''.format('', 'reqs', 'errors', 'req/s', 'p50 ms',
+                                     'p95 ms', 'queries'))
+        for name, row in sorted(report['scenarios'].iteritems()):
+            if not row['requests']:
+                continue
+            self.stdout.write(
+                u'{:<26} {:>6} {:>6} {:>8.1f} {:>9.1f} {:>9.1f} {:>8.1f}'
+                u''.format(name, row['requests'], row['errors'], row['rps'],
+                           row['p50_ms'], row['p95_ms'], row['queries_avg']))
+        self.stdout.write(u'Peak RSS: {} kB ({})'.format(
+            report['peak_rss_kb'], report['database']))
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Max
+
+from rovidtav.models import BaseAttachment, Blob
+
+
+def _mb(size):
+    return u'{:.1f} MB'.format(size / 1024.0 / 1024.0)
+
+
+class Command(BaseCommand):
+    help = (
+        'Reports how much space the deduplication of the attachment '
+        'contents saves. With --rebuild-refs the reference counters are '
+        'recalculated from the attachment tables.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild-refs', action='store_true',
+                            default=False,
+                            help='Recalculate the blob reference counters')
+
+    def handle(self, *args, **options):
+        blobs = {}
+        legacy = 0
+        for cls in BaseAttachment.__subclasses__():
+            rows = cls.objects.filter(blob_hash__isnull=False) \
+                .values('blob_hash') \
+                .annotate(refs=Count('pk'), size=Max('size'))
+            for row in rows:
+                refs, size = blobs.get(row['blob_hash'], (0, 0))
+                blobs[row['blob_hash']] = (refs + row['refs'],
+                                           max(size, row['size'] or 0))
+            legacy += cls.objects.filter(blob_hash__isnull=True).count()
+
+        if options['rebuild_refs']:
+            with transaction.atomic():
+                Blob.objects.exclude(pk__in=blobs.keys()).delete()
+                for blob_hash, (refs, size) in blobs.items():
+                    Blob.objects.update_or_create(
+                        blob_hash=blob_hash,
+                        defaults={'refs': refs, 'size': size})
+            self.stdout.write(u'{} reference counters rebuilt'
+                              u''.format(len(blobs)))
+
+        attachments = sum(refs for refs, _ in blobs.values())
+        logical = sum(refs * size for refs, size in blobs.values())
+        stored = sum(size for _, size in blobs.values())
+        saved = logical - stored
+
+        self.stdout.write(u'Attachments in the blob store: {}'
+                          u''.format(attachments))
+        self.stdout.write(u'Distinct contents:             {}'
+                          u''.format(len(blobs)))
+        self.stdout.write(u'Size without deduplication:    {}'
+                          u''.format(_mb(logical)))
+        self.stdout.write(u'Stored size:                   {}'
+                          u''.format(_mb(stored)))
+        self.stdout.write(u'Saved:                         {} ({:.1f}%)'
+                          u''.format(_mb(saved),
+                                     100.0 * saved / logical if logical
+                                     else 0))
+        if legacy:
+            self.stdout.write(u'Attachments not yet moved to the blob '
+                              u'store: {} (see migrate_attachment_blobs)'
+                              u''.format(legacy))
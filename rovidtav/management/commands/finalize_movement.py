@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from rovidtav import stock
+from rovidtav.models import MaterialMovement
+
+
+class Command(BaseCommand):
+    help = (
+        'Finalizes a material movement like the Véglegesít action of the '
+        'admin, showing the progress of the device reassignments.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('delivery_num',
+                            help='Delivery number of the movement')
+        parser.add_argument('--user', required=True,
+                            help='Username recorded as the finalizer')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(u'No user {}'.format(options['user']))
+        try:
+            movement = MaterialMovement.objects.get(
+                delivery_num=options['delivery_num'])
+        except MaterialMovement.DoesNotExist:
+            raise CommandError(u'No movement {}'
+                               u''.format(options['delivery_num']))
+        except MaterialMovement.MultipleObjectsReturned:
+            raise CommandError(u'More movements with {}'
+                               u''.format(options['delivery_num']))
+
+        def progress(done, total):
+            self.stdout.write(u'{}/{} devices'.format(done, total))
+
+        if not stock.finalize(movement, user, progress=progress):
+            raise CommandError(u'{} has already been finalized'
+                               u''.format(movement.delivery_num))
+        self.stdout.write(u'{} finalized'.format(movement.delivery_num))
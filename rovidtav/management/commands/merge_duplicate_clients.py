@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from rovidtav.merging import move_relations
+from rovidtav.models import Client
+
+
+def merge_clients(survivor, duplicates):
+    """
+    Moves the tickets, devices, etc. of the duplicates to the survivor and
+    deletes the duplicates. The contact details of the newest client are
+    kept, those are the most likely to be up to date.
+    """
+    newest = duplicates[-1]
+    move_relations(survivor, duplicates)
+    Client.objects.filter(pk=survivor.pk).update(
+        address=newest.address or survivor.address,
+        phone=newest.phone or survivor.phone)
+    Client.objects.filter(pk__in=[dup.pk for dup in duplicates]).delete()
+
+
+class Command(BaseCommand):
+    help = (
+        'Reports and merges the clients with the same match key (mt_id, '
+        'city and name without accents and case differences). The oldest '
+        'client of each group is kept. Run backfill_client_match_keys '
+        'first.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only report the duplicates')
+
+    def handle(self, *args, **options):
+        missing = Client.objects.filter(match_key__isnull=True).count()
+        if missing:
+            self.stdout.write(u'{} clients without match key are skipped'
+                              u''.format(missing))
+
+        groups = Client.objects.exclude(match_key__isnull=True) \
+            .values('match_key').annotate(count=Count('pk')) \
+            .filter(count__gt=1).order_by('match_key')
+        keys = [group['match_key'] for group in groups]
+        self.stdout.write(u'{} duplicated clients'.format(len(keys)))
+
+        merged = 0
+        for key in keys:
+            clients = list(Client.objects.filter(match_key=key)
+                           .order_by('pk'))
+            survivor, duplicates = clients[0], clients[1:]
+            self.stdout.write(u'  {}: #{} kept, {} merged'.format(
+                survivor, survivor.pk,
+                u', '.join(u'#{}'.format(dup.pk) for dup in duplicates)))
+            if not options['dry_run']:
+                with transaction.atomic():
+                    merge_clients(survivor, duplicates)
+                merged += len(duplicates)
+
+        self.stdout.write(u'{} clients merged'.format(merged))
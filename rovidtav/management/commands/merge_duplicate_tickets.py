@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from rovidtav.merging import move_relations
+from rovidtav.models import Ticket, UninstallTicket, Note
+
+
+def merge_tickets(survivor, duplicates):
+    """
+    Moves everything referring to the duplicates to the survivor and
+    deletes the duplicates
+    """
+    model = type(survivor)
+    dup_pks = [dup.pk for dup in duplicates]
+    move_relations(survivor, duplicates)
+
+    # The attachments have been moved by UPDATEs, has_images is not
+    # maintained by them
+    if any(getattr(dup, 'has_images', False) for dup in duplicates):
+        model.objects.filter(pk=survivor.pk).update(has_images=True)
+
+    Note.objects.create(
+        content_object=survivor,
+        is_history=True,
+        remark=u'Összevonva a duplikált jegyekkel: {}'.format(
+            u', '.join(u'#{}'.format(pk) for pk in dup_pks)),
+        created_by=survivor.created_by,
+    )
+
+    # Nothing refers to the duplicates anymore, nothing is cascaded
+    model.objects.filter(pk__in=dup_pks).delete()
+
+
+class Command(BaseCommand):
+    help = (
+        'Reports and merges the tickets with the same ext_id, which has to '
+        'be done before the unique index of ext_id is created. The oldest '
+        'ticket of each group is kept.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only report the duplicates')
+
+    def handle(self, *args, **options):
+        for model in (Ticket, UninstallTicket):
+            groups = model.objects.values('ext_id') \
+                .annotate(count=Count('pk')).filter(count__gt=1) \
+                .order_by('ext_id')
+            ext_ids = [group['ext_id'] for group in groups]
+            self.stdout.write(u'{}: {} duplicated ext_id'
+                              u''.format(model.__name__, len(ext_ids)))
+            for ext_id in ext_ids:
+                tickets = list(model.objects.filter(ext_id=ext_id)
+                               .order_by('pk'))
+                survivor, duplicates = tickets[0], tickets[1:]
+                self.stdout.write(u'  {}: #{} kept, {} merged'.format(
+                    ext_id, survivor.pk,
+                    u', '.join(u'#{}'.format(dup.pk) for dup in duplicates)))
+                if not options['dry_run']:
+                    with transaction.atomic():
+                        merge_tickets(survivor, duplicates)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import base64
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from rovidtav.models import BaseAttachment, acquire_blob
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves the base64 encoded attachment payloads from the database to '
+        'the blob store. Rows are processed in chunks, the command can be '
+        'interrupted and restarted safely.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=50,
+                            help='Number of rows moved per transaction')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        for cls in BaseAttachment.__subclasses__():
+            pks = list(cls.objects.filter(blob_hash__isnull=True)
+                       .values_list('pk', flat=True).order_by('pk'))
+            self.stdout.write(u'{}: {} attachments to move'
+                              u''.format(cls.__name__, len(pks)))
+            for start in range(0, len(pks), chunk_size):
+                with transaction.atomic():
+                    for pk in pks[start:start + chunk_size]:
+                        # Load the rows one by one, only the payload and
+                        # the name, to keep the memory footprint low
+                        att = cls.objects.with_data() \
+                            .only('name', '_data').get(pk=pk)
+                        blob_hash, size = acquire_blob(
+                            base64.b64decode(att._data or ''))
+                        mime_type = att._guess_content_type()
+                        cls.objects.filter(pk=pk).update(
+                            blob_hash=blob_hash, size=size,
+                            mime_type=mime_type,
+                            image=mime_type.startswith('image'), _data=None)
+                self.stdout.write(u'{}: {}/{}'.format(
+                    cls.__name__, min(start + chunk_size, len(pks)),
+                    len(pks)))
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+from multiprocessing import Pool
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from rovidtav.models import BaseAttachment, release_blob
+from rovidtav.thumbnails import get_thumbnail_cache
+
+
+def _orient_one(job):
+    """
+    Applies the EXIF orientation on a single attachment. Runs in a worker
+    process. Returns True if the stored content has been changed, False if
+    not and the error message if it failed.
+    """
+    model_label, pk = job
+    model = apps.get_model(model_label)
+    att = None
+    try:
+        att = model.objects.get(pk=pk)
+        return _orient(model, att)
+    except model.DoesNotExist:
+        # Deleted in the meantime
+        return False
+    except Exception as e:
+        # One broken image must not stop the backfill
+        error = u'{} ID {}: {!r}'.format(model_label, pk, e)
+        remark = u'Forgatás sikertelen: {!r}'.format(e)
+        if att is not None and att.remark:
+            remark = u'{}\n{}'.format(att.remark, remark)
+        try:
+            model.objects.filter(pk=pk).update(oriented=True, remark=remark)
+        except Exception as e:
+            error = u'{} (not marked: {!r})'.format(error, e)
+        return error
+
+
+def _orient(model, att):
+    pk = att.pk
+    with att.data as blob:
+        raw = blob.read()
+    try:
+        oriented = att.normalize_image(raw, downscale=False)
+    except IOError:
+        # Not a readable image, nothing to do with it
+        model.objects.filter(pk=pk).update(oriented=True)
+        return False
+
+    old_hash = att.blob_hash
+    if oriented is raw and old_hash:
+        model.objects.filter(pk=pk).update(oriented=True)
+        return False
+
+    att.store_data(oriented)
+    # The content may have been replaced in the meantime
+    updated = model.objects.filter(pk=pk, blob_hash=old_hash).update(
+        blob_hash=att.blob_hash, size=att.size, mime_type=att.mime_type,
+        image=att.image, oriented=True, _data=None)
+    if not updated:
+        release_blob(att.blob_hash)
+        return False
+    get_thumbnail_cache().invalidate(att)
+    release_blob(old_hash)
+    return True
+
+
+class Command(BaseCommand):
+    help = (
+        'Applies the EXIF orientation on the stored images which were '
+        'uploaded before the orientation was normalized at upload time.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None,
+                            help='Number of worker processes '
+                                 '(default: number of CPUs)')
+
+    def handle(self, *args, **options):
+        jobs = []
+        for cls in BaseAttachment.__subclasses__():
+            for pk, name, mime_type, image in cls.objects \
+                    .filter(oriented=False) \
+                    .values_list('pk', 'name', 'mime_type', 'image'):
+                att = cls(pk=pk, name=name, mime_type=mime_type, image=image)
+                if att.is_image():
+                    jobs.append((cls._meta.label, pk))
+
+        self.stdout.write(u'{} images to orient'.format(len(jobs)))
+        if not jobs:
+            return
+
+        # The forked workers must not share the database connection
+        connections.close_all()
+        pool = Pool(processes=options['processes'])
+        rotated = 0
+        try:
+            for idx, result in enumerate(
+                    pool.imap_unordered(_orient_one, jobs, chunksize=10), 1):
+                if result is True:
+                    rotated += 1
+                elif result:
+                    self.stderr.write(u'FAILED {}'.format(result))
+                if idx % 100 == 0:
+                    self.stdout.write(u'{}/{}'.format(idx, len(jobs)))
+        finally:
+            pool.close()
+            pool.join()
+
+        self.stdout.write(u'{} images checked, {} rotated'
+                          u''.format(len(jobs), rotated))
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import time
+from multiprocessing import Pool
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from rovidtav.models import BaseAttachment, release_blob
+from rovidtav.settings import IMAGE_THUMB_PX
+from rovidtav.imaging import render
+from rovidtav.thumbnails import get_thumbnail_cache
+
+
+def _process_one(job):
+    """
+    Orients and downscales a queued image and pre-generates its thumbnail.
+    Runs in a worker process. Returns True if the image was processed, False
+    if it was not queued anymore and the error message if it failed.
+    """
+    model_label, pk = job
+    model = apps.get_model(model_label)
+    att = None
+    try:
+        att = model.objects.get(pk=pk, processed=False)
+        return _process(model, att)
+    except model.DoesNotExist:
+        # Deleted or processed in the meantime
+        return False
+    except Exception as e:
+        # A broken upload must not block the queue, it is left as uploaded
+        error = u'{} ID {}: {!r}'.format(model_label, pk, e)
+        remark = u'Feldolgozás sikertelen: {!r}'.format(e)
+        if att is not None and att.remark:
+            remark = u'{}\n{}'.format(att.remark, remark)
+        try:
+            model.objects.filter(pk=pk).update(processed=True,
+                                               downscale=False,
+                                               remark=remark)
+        except Exception as e:
+            error = u'{} (not marked: {!r})'.format(error, e)
+        return error
+
+
+def _process(model, att):
+    pk = att.pk
+    old_hash = att.blob_hash
+    stored = att.process()
+    # The row may have been deleted or its content replaced in the meantime
+    updated = model.objects.filter(pk=pk, processed=False,
+                                   blob_hash=old_hash).update(
+        blob_hash=att.blob_hash, size=att.size, mime_type=att.mime_type,
+        image=att.image, oriented=att.oriented, processed=True,
+        downscale=False)
+    if not updated:
+        if stored:
+            release_blob(att.blob_hash)
+        return False
+
+    # The image is processed, a missing thumbnail is rendered on request
+    cache = get_thumbnail_cache()
+    cache.invalidate(att)
+    try:
+        with att.data as blob:
+            cache.put(cache.key(att), render(blob, att.name, IMAGE_THUMB_PX))
+    except Exception:
+        pass
+    if stored:
+        release_blob(old_hash)
+    return True
+
+
+class Command(BaseCommand):
+    help = (
+        'Processes the uploaded images in the background: applies the EXIF '
+        'orientation, downscales them and generates the thumbnails.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None,
+                            help='Number of worker processes '
+                                 '(default: number of CPUs)')
+        parser.add_argument('--interval', type=int, default=5,
+                            help='Seconds to wait between polls when the '
+                                 'queue is empty')
+        parser.add_argument('--once', action='store_true', default=False,
+                            help='Process the queue once and exit')
+
+    def _pending(self):
+        jobs = []
+        for cls in BaseAttachment.__subclasses__():
+            jobs.extend((cls._meta.label, pk) for pk in cls.objects
+                        .filter(processed=False).order_by('pk')
+                        .values_list('pk', flat=True))
+        return jobs
+
+    def handle(self, *args, **options):
+        # The forked workers must not share the database connection
+        connections.close_all()
+        pool = Pool(processes=options['processes'])
+        try:
+            while True:
+                jobs = self._pending()
+                if jobs:
+                    processed = 0
+                    for result in pool.imap_unordered(_process_one, jobs):
+                        if result is True:
+                            processed += 1
+                        elif result:
+                            self.stderr.write(u'FAILED {}'.format(result))
+                    self.stdout.write(u'{} images processed'
+                                      u''.format(processed))
+                if options['once']:
+                    break
+                if not jobs:
+                    time.sleep(options['interval'])
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import time
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from rovidtav import ingest
+from rovidtav.models import Const, IngestJob
+
+# The attachments refer to the tickets, these jobs run after the others
+ATTACHMENT_KINDS = (IngestJob.TICKET_ATTACHMENT, IngestJob.TICKET_ATTACHMENTS)
+
+
+class Command(BaseCommand):
+    help = (
+        'Processes the payloads queued by the create endpoints called with '
+        'the async parameter.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None,
+                            help='Number of worker processes '
+                                 '(default: number of CPUs)')
+        parser.add_argument('--interval', type=int, default=5,
+                            help='Seconds to wait between polls when the '
+                                 'queue is empty')
+        parser.add_argument('--stale-after', type=int, default=600,
+                            help='Jobs in progress for longer than this many '
+                                 'seconds are queued again')
+        parser.add_argument('--once', action='store_true', default=False,
+                            help='Process the queue once and exit')
+
+    def handle(self, *args, **options):
+        # The forked workers must not share the database connection
+        connections.close_all()
+        pool = Pool(processes=options['processes'])
+        try:
+            while True:
+                requeued = ingest.requeue_stale(options['stale_after'])
+                if requeued:
+                    self.stdout.write(u'{} stale jobs queued again'
+                                      u''.format(requeued))
+                queued = IngestJob.objects \
+                    .filter(status=Const.JobStatus.NEW).order_by('pk')
+                jobs = list(queued.values_list('pk', 'kind'))
+                for attachments in (False, True):
+                    pks = [pk for pk, kind in jobs
+                           if (kind in ATTACHMENT_KINDS) == attachments]
+                    if not pks:
+                        continue
+                    done = sum(pool.imap_unordered(ingest.run_job, pks))
+                    self.stdout.write(u'{} jobs, {} done'
+                                      u''.format(len(pks), done))
+                if options['once']:
+                    break
+                if not jobs:
+                    time.sleep(options['interval'])
+        finally:
+            pool.close()
+            pool.join()
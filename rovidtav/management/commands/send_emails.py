@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from rovidtav import mailqueue, notifications
+
+
+class Command(BaseCommand):
+    help = (
+        'Sends the queued system emails. The failed messages are retried '
+        'with an exponential backoff, see the EMAIL_QUEUE_* settings. The '
+        'ticket assignment notifications are built here too.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of messages sent over one SMTP '
+                                 'connection')
+        parser.add_argument('--interval', type=int, default=10,
+                            help='Seconds to wait between polls when the '
+                                 'queue is empty')
+        parser.add_argument('--once', action='store_true', default=False,
+                            help='Send the due messages once and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            digests = notifications.build_digests()
+            if digests:
+                self.stdout.write(u'{} notifications built'.format(digests))
+            sent, failed = mailqueue.send_pending(options['batch_size'])
+            if sent or failed:
+                self.stdout.write(u'{} sent, {} failed'.format(sent, failed))
+            if options['once'] and sent + failed < options['batch_size']:
+                break
+            if not sent and not failed:
+                time.sleep(options['interval'])
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from rovidtav import stock
+
+
+class Command(BaseCommand):
+    help = (
+        'Maintains the stock ledger. Without options it reports the '
+        'balances which differ from the ledger. --reconcile records the '
+        'differences as corrections, the first run records the opening '
+        'balances. --snapshot saves the current balances for the point in '
+        'time stock queries, run it periodically.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reconcile', action='store_true', default=False,
+                            help='Record the differences as corrections')
+        parser.add_argument('--user',
+                            help='Username recorded in the corrections')
+        parser.add_argument('--snapshot', action='store_true', default=False,
+                            help='Save a snapshot of the balances')
+
+    def handle(self, *args, **options):
+        if options['reconcile']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(u'No user {}'.format(options['user']))
+            self.stdout.write(u'{} corrections recorded'
+                              u''.format(stock.reconcile(user)))
+        elif not options['snapshot']:
+            diffs = stock.differences()
+            for (warehouse_id, material_id, location_id), (balance, total) \
+                    in sorted(diffs.items()):
+                self.stdout.write(
+                    u'warehouse #{} material #{} location #{}: balance {:g},'
+                    u' ledger {:g}'.format(warehouse_id, material_id,
+                                           location_id, balance, total))
+            self.stdout.write(u'{} differences'.format(len(diffs)))
+
+        if options['snapshot']:
+            snapshot = stock.take_snapshot()
+            self.stdout.write(u'Snapshot #{} saved ({} lines)'.format(
+                snapshot.pk, snapshot.lines.count()))
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+from django.apps import apps
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
+
+
+def _generic_relations():
+    """
+    Returns the (model, content_type field, object_id field) of every
+    generic foreign key
+    """
+    for model in apps.get_models():
+        for field in model._meta.private_fields:
+            if isinstance(field, GenericForeignKey):
+                yield model, field.ct_field, field.fk_field
+
+
+def move_relations(survivor, duplicates):
+    """
+    Moves everything referring to the duplicates to the survivor: the
+    reverse foreign keys, the many to many relations and the generic
+    relations. Nothing refers to the duplicates afterwards, they can be
+    deleted without cascading.
+    """
+    model = type(survivor)
+    dup_pks = [dup.pk for dup in duplicates]
+
+    for rel in model._meta.related_objects:
+        if rel.many_to_many:
+            accessor = rel.get_accessor_name()
+            for dup in duplicates:
+                getattr(survivor, accessor).add(
+                    *getattr(dup, accessor).all())
+        else:
+            rel.related_model.objects \
+                .filter(**{rel.field.name + '__in': dup_pks}) \
+                .update(**{rel.field.name: survivor})
+
+    for field in model._meta.many_to_many:
+        for dup in duplicates:
+            getattr(survivor, field.name).add(
+                *getattr(dup, field.name).all())
+
+    content_type = ContentType.objects.get_for_model(model)
+    for rel_model, ct_field, fk_field in _generic_relations():
+        rel_model.objects.filter(**{
+            ct_field: content_type, fk_field + '__in': dup_pks,
+        }).update(**{fk_field: survivor.pk})
@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import io
 import os
 import re
 import json
 import base64
+import hashlib
 import StringIO
 from datetime import datetime
 
 from unidecode import unidecode
 from PIL import Image
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.db.models.signals import post_delete
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -18,6 +22,9 @@ from multiselectfield import MultiSelectField
 from django.db.utils import IntegrityError
 from django.core.exceptions import ValidationError
 from rovidtav import settings
+from rovidtav.blobstore import get_blob_store
+from rovidtav.thumbnails import get_thumbnail_cache
+from rovidtav.imaging import orient
 
 
 def delivery_num():
@@ -135,6 +142,21 @@ class Const(object):
                 (Const.EmailStatus.FIXED,) * 2,
             )
 
+    class JobStatus:
+        NEW = u'Várakozik'
+        IN_PROGRESS = u'Folyamatban'
+        DONE = u'Kész'
+        ERROR = u'Sikertelen'
+
+        @staticmethod
+        def choices():
+            return (
+                (Const.JobStatus.NEW,) * 2,
+                (Const.JobStatus.IN_PROGRESS,) * 2,
+                (Const.JobStatus.DONE,) * 2,
+                (Const.JobStatus.ERROR,) * 2,
+            )
+
     class PSUPlacement:
         IN_BUILDING = u'Épületen belül'
         OUTSIDE_RACK = u'Kültéri szekrény'
@@ -280,6 +302,11 @@ class Client(BaseEntity):
     created_by = models.ForeignKey(User, db_column='letrehozas_fh',
                                    editable=False,
                                    verbose_name=u'Létrehozó')
+    # The client of a ticket payload is looked up by this key, see
+    # make_match_key. Filled by the backfill_client_match_keys command for
+    # the clients created before it was introduced.
+    match_key = models.CharField(db_column='egyezes_kulcs', max_length=160,
+                                 db_index=True, null=True, editable=False)
 
     class Meta:
         db_table = 'ugyfel'
@@ -293,6 +320,23 @@ class Client(BaseEntity):
     def autocomplete_search_fields():
         return ('name', 'mt_id')
 
+    @staticmethod
+    def make_match_key(mt_id, city_id, name):
+        """
+        The mt_id, the city and the name without accents, punctuation and
+        case differences, e.g. 123|42|kovacs janos
+        """
+        if isinstance(name, str):
+            name = name.decode('utf-8')
+        name = re.sub(r'[^a-z0-9]+', ' ', unidecode(name or u'').lower())
+        return u'{}|{}|{}'.format(unicode(mt_id).strip(), city_id,
+                                  name.strip())[:160]
+
+    def save(self, *args, **kwargs):
+        self.match_key = self.make_match_key(self.mt_id, self.city_id,
+                                             self.name)
+        super(Client, self).save(*args, **kwargs)
+
 
 class DeviceType(BaseEntity):
 
@@ -531,7 +575,7 @@ class BaseTicket(BaseHub):
 class WorkItemTicket(BaseTicket):
 
     ext_id = models.CharField(db_column='kulso_id', max_length=20,
-                              verbose_name=u'Jegy ID')
+                              unique=True, verbose_name=u'Jegy ID')
     client = models.ForeignKey(Client, db_column='ugyfel',
                                verbose_name=u'Ügyfél')
     agreed_time_from = models.DateTimeField(
@@ -620,6 +664,10 @@ class UninstallTicketRule(BaseEntity):
             related_query_name="%(class)s_kiad",
             null=False, blank=False, verbose_name=u'Szerelő',
             limit_choices_to={'groups__name': u'Leszerelő'})
+    # Tells the other processes that their cached rules are stale, see
+    # refcache.uninstall_rules
+    modified_at = models.DateTimeField(db_column='modositva', auto_now=True,
+                                       null=True, editable=False)
 
     class Meta:
         verbose_name = u'Leszerelés jegy szabály'
@@ -910,13 +958,6 @@ class Ticket(WorkItemTicket, JsonExtended):
         """
         COLLECTABLE_MONEY = u'Beszedés'
 
-    def refresh_has_images(self):
-        atts = Attachment.objects.filter(ticket=self)
-        for att in atts:
-            if att.is_image() and not att.name.lower().startswith('imdb'):
-                self.has_images = True
-                self.save()
-
     @property
     def technology(self):
         if not hasattr(self, '_technology'):
@@ -1294,6 +1335,84 @@ class WarehouseMaterial(BaseMaterial):
         verbose_name_plural = u'Raktár anyagok'
 
 
+class StockEntry(BaseEntity):
+    """
+    A change of the stock of a warehouse. The entries are never modified,
+    the WarehouseMaterial rows hold their running balance, see
+    rovidtav.stock.
+    """
+
+    MOVEMENT = 'movement'
+    CONSUMPTION = 'consumption'
+    CORRECTION = 'correction'
+
+    warehouse = models.ForeignKey(Warehouse, db_column='raktar',
+                                  verbose_name=u'Készlet')
+    material = models.ForeignKey(Material, db_column='anyag',
+                                 verbose_name=u'Anyag')
+    location = models.ForeignKey(WarehouseLocation, db_column='raktar_hely',
+                                 null=True, blank=True,
+                                 verbose_name=u'Raktár hely')
+    amount = models.FloatField(db_column='mennyiseg',
+                               verbose_name=u'Mennyiség')
+    kind = models.CharField(db_column='fajta', max_length=20,
+                            verbose_name=u'Fajta',
+                            choices=(
+                                (MOVEMENT, u'Anyagmozgás'),
+                                (CONSUMPTION, u'Felhasználás'),
+                                (CORRECTION, u'Korrekció'),
+                            ))
+    materialmovement = models.ForeignKey(MaterialMovement,
+                                         db_column='anyagmozgas',
+                                         null=True, blank=True,
+                                         verbose_name=u'Anyagmozgás')
+    created_at = models.DateTimeField(auto_now_add=True, editable=False,
+                                      verbose_name=u'Létrehozva')
+    created_by = models.ForeignKey(User, editable=False,
+                                   verbose_name=u'Létrehozó')
+
+    class Meta:
+        db_table = 'raktar_naplo'
+        verbose_name = u'Készletváltozás'
+        verbose_name_plural = u'Készletváltozások'
+        index_together = (('warehouse', 'created_at'),)
+
+    def __unicode__(self):
+        return u'{} {} {:+g}'.format(self.warehouse, self.material,
+                                     self.amount)
+
+
+class StockSnapshot(BaseEntity):
+    """
+    The balances summed from the ledger up to and including last_entry
+    """
+
+    taken_at = models.DateTimeField(auto_now_add=True, db_index=True,
+                                    verbose_name=u'Időpont')
+    last_entry = models.IntegerField(db_column='utolso_tetel',
+                                     verbose_name=u'Utolsó tétel')
+
+    class Meta:
+        db_table = 'raktar_pillanatkep'
+        verbose_name = u'Készlet pillanatkép'
+        verbose_name_plural = u'Készlet pillanatképek'
+
+
+class StockSnapshotLine(BaseEntity):
+
+    snapshot = models.ForeignKey(StockSnapshot, db_column='pillanatkep',
+                                 related_name='lines')
+    warehouse = models.ForeignKey(Warehouse, db_column='raktar')
+    material = models.ForeignKey(Material, db_column='anyag')
+    location = models.ForeignKey(WarehouseLocation, db_column='raktar_hely',
+                                 null=True, blank=True)
+    amount = models.FloatField(db_column='mennyiseg')
+
+    class Meta:
+        db_table = 'raktar_pillanatkep_tetel'
+        index_together = (('snapshot', 'warehouse'),)
+
+
 class WorkItem(BaseEntity):
 
     name = models.CharField(db_column='nev', max_length=300,
@@ -1409,16 +1528,95 @@ class NTNEWorkItem(WorkItemBase):
         verbose_name_plural = u'Hálózati elem munkák'
 
 
+class Blob(models.Model):
+
+    """
+    Reference counter of the attachment contents in the blob store. The
+    same content is stored only once, no matter how many attachments (in
+    any of the attachment tables) refer to it.
+    """
+
+    blob_hash = models.CharField(db_column='hash', max_length=64,
+                                 primary_key=True)
+    size = models.PositiveIntegerField(db_column='meret',
+                                       verbose_name=u'Méret')
+    refs = models.PositiveIntegerField(db_column='hivatkozasok', default=0,
+                                       verbose_name=u'Hivatkozások')
+
+    class Meta:
+        db_table = 'adat_blob'
+        verbose_name = u'Tárolt tartalom'
+        verbose_name_plural = u'Tárolt tartalmak'
+
+    def __unicode__(self):
+        return self.blob_hash
+
+
+class AttachmentQuerySet(models.QuerySet):
+
+    def with_data(self):
+        """
+        Loads the legacy payload column as well
+        """
+        return self.defer(None)
+
+    def images(self):
+        return self.filter(image=True)
+
+
+class AttachmentManager(models.Manager.from_queryset(AttachmentQuerySet)):
+    """
+    The payload column is deferred by default, the lists and inlines only
+    need the metadata
+    """
+
+    def get_queryset(self):
+        return super(AttachmentManager, self).get_queryset().defer('_data')
+
+
 class BaseAttachment(BaseEntity):
 
     class Meta:
         abstract = True
 
+    objects = AttachmentManager()
+
+    # Foreign key of the parent maintaining a has_images column
+    has_images_fk = None
+
+    B64_RE = re.compile(r'^(?:[A-Za-z0-9+/]{4})*'
+                        r'(?:[A-Za-z0-9+/]{2}==|[A-Za-z0-9+/]{3}=)?$')
+
     name = models.CharField(db_column='nev', max_length=120,
                             verbose_name=u'Név',
                             null=True, blank=True)
+    # Legacy base64 payload. New attachments keep their content in the blob
+    # store, this is only used to hand over the incoming data to save() and
+    # for rows not yet moved by the migrate_attachment_blobs command
     _data = models.TextField(db_column='adat',
-                             verbose_name=u'Adat')
+                             verbose_name=u'Adat',
+                             null=True, blank=True)
+    blob_hash = models.CharField(db_column='adat_hash', max_length=64,
+                                 null=True, blank=True, db_index=True,
+                                 editable=False)
+    size = models.PositiveIntegerField(db_column='meret',
+                                       null=True, blank=True,
+                                       editable=False,
+                                       verbose_name=u'Méret')
+    mime_type = models.CharField(db_column='mime_tipus', max_length=120,
+                                 null=True, blank=True, editable=False)
+    image = models.NullBooleanField(db_column='kep', editable=False,
+                                    verbose_name=u'Kép')
+    # Images have the EXIF orientation applied on the stored content
+    oriented = models.BooleanField(db_column='forgatva', default=False,
+                                   editable=False)
+    # Uploaded images are stored as they arrive, the orientation and the
+    # downscaling is done by the process_attachments worker
+    processed = models.BooleanField(db_column='feldolgozva', default=True,
+                                    editable=False,
+                                    verbose_name=u'Feldolgozva')
+    downscale = models.BooleanField(db_column='kicsinyites', default=False,
+                                    editable=False)
     remark = models.TextField(db_column='megjegyzes',
                               verbose_name=u'Megjegyzés',
                               null=True, blank=True)
@@ -1434,10 +1632,18 @@ class BaseAttachment(BaseEntity):
 
     @property
     def data(self):
-        return base64.b64decode(self._data)
+        """
+        A file-like reader of the raw content
+        """
+        if self.blob_hash:
+            return get_blob_store().open(self.blob_hash)
+        return io.BytesIO(base64.b64decode(self._data or ''))
 
     @property
     def content_type(self):
+        return self.mime_type or self._guess_content_type()
+
+    def _guess_content_type(self):
         _, ext = os.path.splitext(self.name)
         return Const.EXT_MAP.get(ext.lower(), 'application/force-download')
 
@@ -1450,40 +1656,179 @@ class BaseAttachment(BaseEntity):
         return u'{}; filename="{}"'.format(cd, self.name)
 
     def is_image(self):
+        if self.image is not None:
+            return self.image
         return self.content_type.startswith('image')
 
     def __unicode__(self):
         return self.name
 
-    def save(self, *args, **kwargs):
-        # Check if the data is already encoded b64
-        r = re.compile(r'^(?:[A-Za-z0-9+/]{4})*'
-                       r'(?:[A-Za-z0-9+/]{2}==|[A-Za-z0-9+/]{3}=)?$')
-
-        if not r.match(self._data):
-            if self.is_image() and not self.name.lower().startswith('imdb'):
-                temp_buff = StringIO.StringIO()
-                temp_buff.write(self._data)
-                temp_buff.seek(0)
-
-                img = Image.open(temp_buff)
-                pixels = settings.IMAGE_DOWNSCALE_PX
-                img.thumbnail((pixels, pixels), Image.ANTIALIAS)
-                temp_buff = StringIO.StringIO()
-                temp_buff.name = self.name
-                img.save(temp_buff, exif=img.info.get('exif', b''))
-                temp_buff.seek(0)
-                self._data = temp_buff.read()
-
-            self._data = base64.b64encode(self._data)
+    def counts_as_image(self):
+        """
+        The imdb images are not taken into account for has_images
+        """
+        return (self.is_image() and
+                not (self.name or '').lower().startswith('imdb'))
 
-        super(BaseAttachment, self).save(*args, **kwargs)
+    @staticmethod
+    def _image_q():
+        """
+        The filter version of is_image(), the rows not processed yet have no
+        image flag and are decided by their content type like there
+        """
+        by_ext = Q()
+        for ext, content_type in Const.EXT_MAP.items():
+            if content_type.startswith('image'):
+                by_ext |= Q(name__iendswith=ext)
+        untyped = Q(mime_type__isnull=True) | Q(mime_type='')
+        return Q(image=True) | (Q(image__isnull=True) & (
+            Q(mime_type__startswith='image') | (untyped & by_ext)))
+
+    def update_has_images(self, created=False, deleted=False):
+        """
+        Maintains the has_images column of the parent with a single
+        conditional UPDATE
+        """
+        if not self.has_images_fk:
+            return
+        fk = self._meta.get_field(self.has_images_fk)
+        parent_id = getattr(self, fk.attname)
+        parents = fk.related_model.objects.filter(pk=parent_id)
+        if self.counts_as_image() and not deleted:
+            parents.filter(has_images=False).update(has_images=True)
+        elif not created:
+            images = type(self).objects.filter(**{fk.attname: parent_id}) \
+                .filter(self._image_q()).exclude(name__istartswith='imdb')
+            parents.filter(has_images=True) \
+                .exclude(pk__in=images.values(fk.attname)) \
+                .update(has_images=False)
+
+    def _raw_payload(self):
+        """
+        Returns the incoming payload as raw bytes. The payload can be either
+        base64 encoded (api) or raw (admin upload). Images are only queued
+        for processing here, raw images are going to be downscaled.
+        """
+        if self.B64_RE.match(self._data):
+            raw = base64.b64decode(self._data)
+            downscale = False
+        else:
+            raw = self._data
+            downscale = not self.name.lower().startswith('imdb')
 
+        self._queue_processing(downscale)
+        return raw
+
+    def _queue_processing(self, downscale):
+        if self._guess_content_type().startswith('image'):
+            self.processed = False
+            self.oriented = False
+            self.downscale = downscale
+
+    def process(self):
+        """
+        Normalizes a queued image and stores the result. Returns True if a
+        new content has been stored, the reference of the blob it was read
+        from is to be released by the caller.
+        """
+        with self.data as blob:
+            raw = blob.read()
         try:
-            self.ticket.refresh_has_images()
-        except AttributeError:
-            # We're not maintaining the boolean for having images
-            pass
+            normalized = self.normalize_image(raw, downscale=self.downscale)
+        except IOError:
+            # Not a readable image, keep it as it is
+            normalized = raw
+            self.oriented = True
+
+        self.processed = True
+        self.downscale = False
+        if normalized is raw:
+            return False
+        self.store_data(normalized)
+        return True
+
+    def normalize_image(self, raw, downscale=True):
+        """
+        Applies the EXIF orientation and optionally downscales the image to
+        IMAGE_DOWNSCALE_PX. The image is only re-encoded if it has changed.
+        Sets the oriented flag.
+        """
+        img = Image.open(io.BytesIO(raw))
+        exif = img.info.get('exif', b'')
+        img, rotated = orient(img)
+        if downscale:
+            pixels = settings.IMAGE_DOWNSCALE_PX
+            img.thumbnail((pixels, pixels), Image.ANTIALIAS)
+
+        if rotated or downscale:
+            temp_buff = StringIO.StringIO()
+            temp_buff.name = self.name
+            if rotated:
+                # The rotation is applied on the pixels, the EXIF data
+                # with the orientation tag must not be kept
+                img.save(temp_buff)
+            else:
+                img.save(temp_buff, exif=exif)
+            temp_buff.seek(0)
+            raw = temp_buff.read()
+
+        self.oriented = True
+        return raw
+
+    def store_data(self, raw):
+        """
+        Puts the raw bytes into the blob store and updates the metadata
+        """
+        self.blob_hash, self.size = acquire_blob(raw)
+        self._stored()
+
+    def store_file(self, fileobj):
+        """
+        Streams the content of a file-like object into the blob store and
+        updates the metadata
+        """
+        self.blob_hash, self.size = acquire_blob_file(fileobj)
+        self._stored()
+
+    def _stored(self):
+        self.mime_type = self._guess_content_type()
+        self.image = self.mime_type.startswith('image')
+        self._data = None
+
+    @property
+    def payload_file(self):
+        """
+        Incoming raw payload as a file-like object, the alternative of _data
+        for large contents (e.g. spilled by rovidtav.jsonstream)
+        """
+        return getattr(self, '_payload_file', None)
+
+    @payload_file.setter
+    def payload_file(self, fileobj):
+        self._payload_file = fileobj
+
+    def save(self, *args, **kwargs):
+        # Bulk inserts refresh has_images once per parent instead
+        update_has_images = kwargs.pop('update_has_images', True)
+        old_hash = None
+        if self.payload_file is not None:
+            old_hash = self.blob_hash
+            self._queue_processing(downscale=False)
+            self.store_file(self.payload_file)
+            self._payload_file = None
+        elif '_data' not in self.get_deferred_fields() and self._data:
+            old_hash = self.blob_hash
+            self.store_data(self._raw_payload())
+        if old_hash is not None and self.pk:
+            get_thumbnail_cache().invalidate(self)
+
+        created = self.pk is None
+        super(BaseAttachment, self).save(*args, **kwargs)
+        if old_hash:
+            # The content has been replaced
+            release_blob(old_hash)
+        if update_has_images:
+            self.update_has_images(created=created)
 
 
 class Attachment(BaseAttachment):
@@ -1491,6 +1836,8 @@ class Attachment(BaseAttachment):
     ticket = models.ForeignKey(Ticket, db_column='jegy',
                                verbose_name=u'Jegy')
 
+    has_images_fk = 'ticket'
+
     class Meta:
         db_table = 'csatolmany'
         verbose_name = u'File'
@@ -1506,6 +1853,8 @@ class NTAttachment(BaseAttachment):
     ticket = models.ForeignKey(NetworkTicket, db_column='jegy',
                                verbose_name=u'Jegy')
 
+    has_images_fk = 'ticket'
+
     class Meta:
         db_table = 'halo_jegy_csatolmany'
         verbose_name = u'File'
@@ -1588,6 +1937,25 @@ class SystemEmail(BaseEntity):
     remark = models.TextField(db_column='megjegyzes',
                               verbose_name=u'Megjegyzés',
                               null=True, blank=True)
+    # The queued message, sent by the send_emails command
+    recipient = models.CharField(db_column='cimzett', max_length=254,
+                                 null=True, blank=True,
+                                 verbose_name=u'Címzett')
+    message = models.TextField(db_column='uzenet', null=True, blank=True,
+                               editable=False)
+    attempts = models.IntegerField(db_column='probalkozasok', default=0,
+                                   verbose_name=u'Próbálkozások')
+    next_attempt_at = models.DateTimeField(db_column='kovetkezo_probalkozas',
+                                           null=True, blank=True,
+                                           db_index=True,
+                                           verbose_name=u'Következő próba')
+    sent_at = models.DateTimeField(db_column='elkuldve', null=True,
+                                   blank=True, verbose_name=u'Elküldve')
+    # Set on the assignments sent together in the message of another row
+    digest = models.ForeignKey('self', db_column='osszesito', null=True,
+                               blank=True, editable=False,
+                               related_name='members',
+                               verbose_name=u'Összesítő email')
 
     created_at = models.DateTimeField(auto_now_add=True, editable=False,
                                       verbose_name=u'Létrehozva')
@@ -1600,6 +1968,68 @@ class SystemEmail(BaseEntity):
         verbose_name_plural = u'Rendszer emailek'
 
 
+class IngestJob(BaseEntity):
+
+    """
+    A payload posted to the create endpoints, waiting to be processed by
+    the process_ingest_queue command
+    """
+
+    TICKET = 'ticket'
+    UNINSTALL_TICKET = 'uninstall_ticket'
+    TICKET_ATTACHMENT = 'ticket_attachment'
+    TICKET_ATTACHMENTS = 'ticket_attachments'
+
+    kind = models.CharField(db_column='fajta', max_length=30,
+                            verbose_name=u'Fajta',
+                            choices=(
+                                (TICKET, u'Jegy'),
+                                (UNINSTALL_TICKET, u'Leszerelés jegy'),
+                                (TICKET_ATTACHMENT, u'Jegy csatolmány'),
+                                (TICKET_ATTACHMENTS, u'Jegy csatolmányok'),
+                            ))
+    # Identifies the payload, posting the same payload again returns the
+    # existing job
+    key = models.CharField(db_column='kulcs', max_length=64, unique=True,
+                           verbose_name=u'Kulcs')
+    payload = models.TextField(db_column='adat', verbose_name=u'Adat')
+    status = models.CharField(
+        db_column='statusz',
+        null=False,
+        blank=False,
+        default=Const.JobStatus.NEW,
+        choices=Const.JobStatus.choices(),
+        max_length=100,
+        db_index=True,
+        verbose_name=u'Státusz',
+    )
+    attempts = models.PositiveIntegerField(db_column='probalkozas',
+                                           default=0,
+                                           verbose_name=u'Próbálkozás')
+    result = models.TextField(db_column='eredmeny', null=True, blank=True,
+                              verbose_name=u'Eredmény')
+    error = models.TextField(db_column='hiba', null=True, blank=True,
+                             verbose_name=u'Hiba')
+
+    created_at = models.DateTimeField(auto_now_add=True, editable=False,
+                                      verbose_name=u'Létrehozva')
+    created_by = models.ForeignKey(User, editable=False,
+                                   verbose_name=u'Létrehozó')
+    started_at = models.DateTimeField(null=True, blank=True, editable=False,
+                                      verbose_name=u'Elkezdve')
+    finished_at = models.DateTimeField(null=True, blank=True, editable=False,
+                                       verbose_name=u'Befejezve')
+
+    class Meta:
+        db_table = 'beerkezo_feladat'
+        verbose_name = u'Beérkező feladat'
+        verbose_name_plural = u'Beérkező feladatok'
+
+    def __unicode__(self):
+        return u'{} #{} - {}'.format(self.get_kind_display(), self.pk,
+                                     self.status)
+
+
 class MaterialWorkitemRule(BaseEntity):
 
     ADD_ONE = 0
@@ -1623,3 +2053,91 @@ class MaterialWorkitemRule(BaseEntity):
         return unicode(u'{} esetén hozzáad {} ({})'
                        u''.format(self.material, self.workitem,
                                   self.get_amount_display()))
+
+
+def attachment_deleted(sender, instance, **kwargs):
+    """
+    Drops the cached thumbnails of the attachment and its blob, unless
+    another attachment has the same content
+    """
+    get_thumbnail_cache().invalidate(instance)
+    release_blob(instance.blob_hash)
+    instance.update_has_images(deleted=True)
+
+
+def acquire_blob(raw):
+    """
+    Stores the content and takes a reference on it. Identical contents are
+    stored only once. Returns a (hash, size) tuple.
+    """
+    blob_hash = hashlib.sha256(raw).hexdigest()
+    with transaction.atomic():
+        # The row lock serializes with release_blob, the content can't be
+        # deleted between storing it and taking the reference
+        blob, _ = Blob.objects.select_for_update().get_or_create(
+            blob_hash=blob_hash, defaults={'size': len(raw)})
+        get_blob_store().put(raw)
+        Blob.objects.filter(pk=blob.pk).update(refs=F('refs') + 1)
+    return blob_hash, len(raw)
+
+
+def acquire_blob_file(fileobj):
+    """
+    Same as acquire_blob for a seekable file-like object. The content is
+    streamed into the store before the reference is taken.
+    """
+    store = get_blob_store()
+    blob_hash, size = store.put_file(fileobj)
+    with transaction.atomic():
+        blob, _ = Blob.objects.select_for_update().get_or_create(
+            blob_hash=blob_hash, defaults={'size': size})
+        if not store.exists(blob_hash):
+            # Released by somebody else before the row lock was taken
+            fileobj.seek(0)
+            store.put_file(fileobj)
+        Blob.objects.filter(pk=blob.pk).update(refs=F('refs') + 1)
+    return blob_hash, size
+
+
+def release_blob(blob_hash):
+    """
+    Drops a reference of the blob. The content is deleted after the commit
+    if no attachment refers to it anymore, a rolled back transaction leaves
+    it in place.
+    """
+    if not blob_hash:
+        return
+    with transaction.atomic():
+        try:
+            blob = Blob.objects.select_for_update().get(blob_hash=blob_hash)
+        except Blob.DoesNotExist:
+            # Not counted yet (see the blob_report command), checked again
+            # after the commit
+            pass
+        else:
+            Blob.objects.filter(pk=blob.pk, refs__gt=0) \
+                .update(refs=F('refs') - 1)
+            if blob.refs > 1:
+                return
+    transaction.on_commit(lambda: _delete_unreferenced(blob_hash))
+
+
+def _delete_unreferenced(blob_hash):
+    """
+    Deletes the content unless it was acquired again since it was released
+    """
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update() \
+            .filter(blob_hash=blob_hash).first()
+        if blob is not None:
+            if blob.refs > 0:
+                return
+            blob.delete()
+        elif any(cls.objects.filter(blob_hash=blob_hash).exists()
+                 for cls in BaseAttachment.__subclasses__()):
+            return
+        get_blob_store().delete(blob_hash)
+
+
+for _attachment_cls in BaseAttachment.__subclasses__():
+    post_delete.connect(attachment_deleted, sender=_attachment_cls)
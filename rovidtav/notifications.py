@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+Email notifications of the technicians about their new tickets. The
+assignments are collected for ASSIGN_DIGEST_WINDOW seconds and each
+technician gets a single email about them, built by the send_emails
+command.
+"""
+
+from datetime import timedelta
+from email.header import Header
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formataddr
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Min
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from rovidtav import mailqueue, settings
+from rovidtav.models import Attachment, Const, SystemEmail, Ticket
+
+# Longer ticket HTMLs are attached instead of being inlined
+HTML_MAXLEN = 100000
+
+
+def queue_assignment(ticket):
+    """
+    Records that ticket was assigned to its owner, the notification is sent
+    with the other assignments of the owner
+    """
+    SystemEmail.objects.create(content_object=ticket,
+                               recipient=ticket.owner.email)
+
+
+def _ticket_url(ticket):
+    return '{}/admin/rovidtav/ticket/{}'.format(settings.SELF_URL, ticket.pk)
+
+
+def _html_attachment(ticket_html, filename):
+    try:
+        attachment = MIMEText(ticket_html.encode('utf-8'), 'html', 'UTF-8')
+    except Exception:
+        attachment = MIMEText(ticket_html, 'html', 'UTF-8')
+    attachment.add_header(u'Content-Disposition',
+                          u'attachment; filename={}'.format(filename))
+    return attachment
+
+
+def _ticket_htmls(tickets):
+    """
+    The Hibajegy.html attachments of the tickets by ticket id, read with a
+    single query
+    """
+    htmls = {}
+    for attachment in Attachment.objects.defer(None).filter(
+            ticket__in=tickets, name='Hibajegy.html'):
+        with attachment.data as blob:
+            htmls[attachment.ticket_id] = blob.read()
+    return htmls
+
+
+def _message(recipient, tickets):
+    """
+    The notification about the tickets. A single ticket is inlined in the
+    email like before, more tickets are listed and their HTMLs are attached.
+    """
+    htmls = _ticket_htmls(tickets)
+    attachments = []
+    if len(tickets) == 1:
+        ticket = tickets[0]
+        ticket_html = htmls.get(ticket.pk, '')
+        if len(ticket_html) > HTML_MAXLEN:
+            attachments.append(_html_attachment(ticket_html,
+                                                'hibajegy.html'))
+        subject = u'Új jegy - {} {} - Task Nr: {}'.format(
+            ticket.city.name, ticket.address, ticket.ext_id)
+        html = render_to_string('assign_notification.html', context={
+            'ticket_url': _ticket_url(ticket),
+            'ticket_html': '' if attachments else ticket_html,
+            'ticket_too_long': bool(attachments)})
+    else:
+        for ticket in tickets:
+            if ticket.pk in htmls:
+                attachments.append(_html_attachment(
+                    htmls[ticket.pk], u'hibajegy_{}.html'.format(
+                        ticket.ext_id)))
+        subject = u'{} új jegy'.format(len(tickets))
+        html = render_to_string('assign_digest_notification.html', context={
+            'tickets': [(ticket, _ticket_url(ticket)) for ticket in tickets]})
+
+    msg = MIMEMultipart()
+    msg['Subject'] = subject
+    msg['From'] = formataddr((str(Header(u'Rövidtáv rendszer', 'utf-8')),
+                              settings.EMAIL_SENDER))
+    msg['To'] = recipient
+    msg.attach(MIMEText(html, 'html', 'utf-8'))
+    for attachment in attachments:
+        msg.attach(attachment)
+    return msg
+
+
+def _pending():
+    return SystemEmail.objects.filter(
+        content_type=ContentType.objects.get_for_model(Ticket),
+        status=Const.EmailStatus.IN_PROGRESS, message__isnull=True,
+        digest__isnull=True, recipient__isnull=False)
+
+
+def build_digests():
+    """
+    Builds the notification of every technician whose first collected
+    assignment is older than the digest window and queues it for sending.
+    Returns the number of queued emails.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.ASSIGN_DIGEST_WINDOW)
+    recipients = list(_pending().values('recipient')
+                      .annotate(first=Min('created_at'))
+                      .filter(first__lte=cutoff)
+                      .values_list('recipient', flat=True).order_by())
+    queued = 0
+    for recipient in recipients:
+        with transaction.atomic():
+            # Built by another worker in the meantime
+            rows = list(_pending().select_for_update()
+                        .filter(recipient=recipient).order_by('pk'))
+            if not rows:
+                continue
+            tickets = Ticket.objects.select_related('city').in_bulk(
+                set(row.object_id for row in rows))
+            # A ticket reassigned more times is listed once
+            ordered = []
+            for row in rows:
+                ticket = tickets.get(row.object_id)
+                if ticket is not None and ticket not in ordered:
+                    ordered.append(ticket)
+            pks = [row.pk for row in rows]
+            if not ordered:
+                SystemEmail.objects.filter(pk__in=pks).update(
+                    status=Const.EmailStatus.ERROR,
+                    remark=u'A jegy időközben törölve lett')
+                continue
+            mailqueue.enqueue(pks[0], _message(recipient, ordered))
+            SystemEmail.objects.filter(pk__in=pks[1:]).update(digest=pks[0])
+            queued += 1
+    return queued
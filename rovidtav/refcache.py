@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from django.db.models import Count, Max
+from django.db.models.signals import post_save, post_delete
+
+from rovidtav.models import (City, TicketType, Tag, DeviceType, NTNEType,
+                             UninstallTicketRule)
+
+
+def _norm(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
+class RefCache(object):
+    """
+    Process-local cache of a small reference table, keyed by its natural
+    key. The whole table is loaded on first use, a miss falls back to the
+    database. Saving or deleting a row in this process drops the cache, the
+    changes made by other processes are picked up after ttl seconds.
+
+    With a version_field (an auto_now timestamp) the version of the table
+    is checked with a single aggregate query on every lookup, so the
+    changes of the other processes are picked up at once. The ttl is only
+    a backstop then.
+    """
+
+    def __init__(self, model, key_fields, ttl=300, version_field=None):
+        self.model = model
+        self.key_fields = key_fields
+        self.ttl = ttl
+        self.version_field = version_field
+        self._rows = None
+        self._index = None
+        self._loaded_at = 0
+        self._version = None
+        dispatch_uid = 'refcache_{}'.format(model._meta.label)
+        post_save.connect(self._changed, sender=model, weak=False,
+                          dispatch_uid=dispatch_uid)
+        post_delete.connect(self._changed, sender=model, weak=False,
+                            dispatch_uid=dispatch_uid)
+
+    def _changed(self, sender, **kwargs):
+        self.invalidate()
+
+    def invalidate(self):
+        self._rows = None
+        self._index = None
+
+    def _key(self, values):
+        return tuple(_norm(values[f]) for f in self.key_fields)
+
+    def _table_version(self):
+        # A deleted row changes the count, a new one the max pk and an
+        # edited one the max timestamp
+        if self.version_field is None:
+            return None
+        row = self.model.objects.aggregate(
+            count=Count('pk'), last_pk=Max('pk'),
+            last_modified=Max(self.version_field))
+        return row['count'], row['last_pk'], row['last_modified']
+
+    def _load(self):
+        version = self._table_version()
+        if self._rows is None or version != self._version or \
+                time.time() - self._loaded_at > self.ttl:
+            rows = list(self.model.objects.order_by('pk'))
+            index = {}
+            for row in rows:
+                index.setdefault(self._key(row.__dict__), row)
+            self._rows, self._index = rows, index
+            self._loaded_at = time.time()
+            self._version = version
+        return self._index
+
+    def all(self):
+        self._load()
+        return list(self._rows)
+
+    def get(self, **kwargs):
+        """
+        Returns the row with the natural key or None
+        """
+        return self._load().get(self._key(kwargs))
+
+    def get_or_create(self, **kwargs):
+        """
+        Same as QuerySet.get_or_create, kwargs must hold the natural key
+        """
+        index = self._load()
+        key = self._key(kwargs)
+        if key in index:
+            return index[key], False
+        # The database may compare case insensitively or the row may have
+        # been created by another process
+        obj, created = self.model.objects.get_or_create(**kwargs)
+        # Saving has dropped the cache, reloaded on the next call
+        if self._index is not None:
+            self._index[key] = obj
+        return obj, created
+
+
+cities = RefCache(City, ('name', 'zip'))
+ticket_types = RefCache(TicketType, ('name',))
+tags = RefCache(Tag, ('name',))
+device_types = RefCache(DeviceType, ('name',))
+ntne_types = RefCache(NTNEType, ('type_str', 'type'))
+# The first rule of a primer assigns its uninstall tickets
+uninstall_rules = RefCache(UninstallTicketRule, ('primer',),
+                           version_field='modified_at')
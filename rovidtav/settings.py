@@ -34,12 +34,28 @@ WKHTMLTOPDF_EXEC = '/usr/local/bin/wkhtmltopdf'
 IMAGE_DOWNSCALE_PX = 900
 IMAGE_THUMB_PX = 180
 
+# Attachment payloads are stored outside of the database, keyed by SHA-256
+BLOB_STORE_BACKEND = 'rovidtav.blobstore.FileSystemBlobStore'
+BLOB_STORE_ROOT = os.path.join(BASE_DIR, 'blobs')
+
+THUMBNAIL_CACHE_ROOT = os.path.join(BASE_DIR, 'thumbnails')
+THUMBNAIL_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
 SELF_URL = 'http://localhost:8000'
 SMTP_SERVER = ''
 SMTP_USER = ''
 SMTP_PASS = ''
 EMAIL_SENDER = ''
 
+# Outbound email queue, see the send_emails command. A failed message is
+# retried after an exponentially growing, jittered delay (seconds).
+EMAIL_QUEUE_MAX_ATTEMPTS = 6
+EMAIL_QUEUE_BACKOFF_BASE = 30
+EMAIL_QUEUE_BACKOFF_MAX = 3600
+# The ticket assignments of a technician are collected for this long
+# (seconds) from the first one and sent in a single email
+ASSIGN_DIGEST_WINDOW = 120
+
 DATA_UPLOAD_MAX_NUMBER_FIELDS = 2000
 DATA_UPLOAD_MAX_MEMORY_SIZE = 15242880
 
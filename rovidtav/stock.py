@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+"""
+The stock of the warehouses. Every change is recorded in the StockEntry
+ledger and applied on the WarehouseMaterial balances in the same
+transaction, with the balance rows locked. The stock at a past date is
+computed from the last snapshot before it and the entries since then.
+"""
+
+from collections import defaultdict
+from datetime import datetime
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, models, transaction
+from django.db.models import Case, Max, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+from rovidtav.models import (
+    Const, Device, DeviceOwner, DeviceReassignEvent, MaterialMovement,
+    MaterialMovementMaterial, Note, StockEntry, StockSnapshot,
+    StockSnapshotLine, Warehouse, WarehouseMaterial)
+
+# Amounts closer to zero than this are considered zero
+EPSILON = 1e-9
+
+# Number of devices reassigned with one set of bulk queries on finalize
+DEVICE_BATCH_SIZE = 500
+
+
+def _lock_balances(pairs):
+    """
+    Locks and returns the balance rows of the (warehouse id, material id)
+    pairs grouped by the pairs, in pk order
+    """
+    rows = defaultdict(list)
+    if not pairs:
+        return rows
+    for row in WarehouseMaterial.objects.select_for_update() \
+            .filter(warehouse__in=set(wh for wh, _ in pairs),
+                    material__in=set(material for _, material in pairs)) \
+            .order_by('pk'):
+        rows[(row.warehouse_id, row.material_id)].append(row)
+    return rows
+
+
+def _update_amounts(rows):
+    """
+    Writes the amounts of the balance rows with a single UPDATE
+    """
+    if rows:
+        WarehouseMaterial.objects.filter(pk__in=[row.pk for row in rows]) \
+            .update(amount=Case(*[When(pk=row.pk, then=Value(row.amount))
+                                  for row in rows],
+                                output_field=models.FloatField()))
+
+
+def add_many(items, kind, user, movement=None):
+    """
+    Adds stock, items are (warehouse id, material id, location id, amount)
+    tuples. The amount goes to the balance row of the location, or to the
+    first row of the material when the location is not given.
+    """
+    with transaction.atomic():
+        balances = _lock_balances([(wh, material)
+                                   for wh, material, _, _ in items])
+        changed = {}
+        created = []
+        entries = []
+        for warehouse_id, material_id, location_id, amount in items:
+            rows = balances[(warehouse_id, material_id)]
+            if location_id:
+                rows = [row for row in rows if row.location_id == location_id]
+            if rows:
+                row = rows[0]
+                row.amount += amount
+                if row.pk:
+                    changed[row.pk] = row
+            else:
+                row = WarehouseMaterial(
+                    warehouse_id=warehouse_id, material_id=material_id,
+                    location_id=location_id, amount=amount, created_by=user)
+                balances[(warehouse_id, material_id)].append(row)
+                created.append(row)
+            entries.append(StockEntry(
+                warehouse_id=warehouse_id, material_id=material_id,
+                location_id=row.location_id, amount=amount, kind=kind,
+                materialmovement=movement, created_by=user))
+
+        _update_amounts(changed.values())
+        WarehouseMaterial.objects.bulk_create(created)
+        StockEntry.objects.bulk_create(entries)
+
+
+def take_many(totals, kind, user, movement=None):
+    """
+    Takes stock, totals maps (warehouse id, material id) to the amount.
+    The balance rows are consumed in pk order and deleted when emptied,
+    the stock does not go below zero. Returns the amounts that could not
+    be taken by the same keys.
+    """
+    with transaction.atomic():
+        balances = _lock_balances(list(totals))
+        remaining = dict(totals)
+        emptied = []
+        changed = []
+        entries = []
+        for key, rows in balances.items():
+            for row in rows:
+                left = remaining.get(key, 0)
+                if left <= EPSILON:
+                    break
+                taken = min(left, row.amount)
+                remaining[key] = left - taken
+                if row.amount - taken <= EPSILON:
+                    emptied.append(row.pk)
+                else:
+                    row.amount -= taken
+                    changed.append(row)
+                if taken > EPSILON:
+                    entries.append(StockEntry(
+                        warehouse_id=row.warehouse_id,
+                        material_id=row.material_id,
+                        location_id=row.location_id, amount=-taken,
+                        kind=kind, materialmovement=movement,
+                        created_by=user))
+
+        WarehouseMaterial.objects.filter(pk__in=emptied).delete()
+        _update_amounts(changed)
+        StockEntry.objects.bulk_create(entries)
+    return remaining
+
+
+def relocate(row, user):
+    """
+    Saves a balance row moved to another location of its warehouse, the
+    move is recorded as a pair of corrections
+    """
+    with transaction.atomic():
+        previous = WarehouseMaterial.objects.select_for_update() \
+            .get(pk=row.pk)
+        if previous.location_id == row.location_id:
+            return
+        WarehouseMaterial.objects.filter(pk=row.pk) \
+            .update(location=row.location_id)
+        StockEntry.objects.bulk_create([
+            StockEntry(warehouse_id=row.warehouse_id,
+                       material_id=row.material_id, location_id=location_id,
+                       amount=amount, kind=StockEntry.CORRECTION,
+                       created_by=user)
+            for location_id, amount in (
+                (previous.location_id, -previous.amount),
+                (row.location_id, previous.amount))])
+
+
+def _ledger_totals(entries):
+    """
+    The sum of the entries by (warehouse id, material id, location id)
+    """
+    return dict(((row['warehouse'], row['material'], row['location']),
+                 row['total'])
+                for row in entries.values('warehouse', 'material', 'location')
+                .annotate(total=Sum('amount')).order_by())
+
+
+def stock_at(warehouse_id, when):
+    """
+    The stock of a warehouse at a point in time as a dict of
+    (material id, location id) -> amount. The last snapshot before the
+    time is found by an index, only the entries after it are summed.
+    """
+    snapshot = StockSnapshot.objects.filter(taken_at__lte=when) \
+        .order_by('-taken_at').first()
+    stock = defaultdict(float)
+    last_entry = 0
+    if snapshot:
+        last_entry = snapshot.last_entry
+        for material_id, location_id, amount in snapshot.lines \
+                .filter(warehouse=warehouse_id) \
+                .values_list('material', 'location', 'amount'):
+            stock[(material_id, location_id)] += amount
+
+    entries = StockEntry.objects.filter(warehouse=warehouse_id,
+                                        pk__gt=last_entry,
+                                        created_at__lte=when)
+    for (_, material_id, location_id), amount in \
+            _ledger_totals(entries).items():
+        stock[(material_id, location_id)] += amount
+    return dict((key, amount) for key, amount in stock.items()
+                if abs(amount) > EPSILON)
+
+
+def take_snapshot():
+    """
+    Saves the balances of every warehouse, summed from the previous
+    snapshot and the entries since then
+    """
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            # Waits for the transactions writing the ledger, an entry with
+            # a lower id must not be committed after the snapshot
+            cursor = connection.cursor()
+            cursor.execute('LOCK TABLE {} IN SHARE MODE'
+                           ''.format(StockEntry._meta.db_table))
+        previous = StockSnapshot.objects.order_by('-pk').first()
+        last_entry = StockEntry.objects.aggregate(last=Max('pk'))['last'] or 0
+
+        balances = defaultdict(float)
+        since = 0
+        if previous:
+            since = previous.last_entry
+            for warehouse_id, material_id, location_id, amount in \
+                    previous.lines.values_list('warehouse', 'material',
+                                               'location', 'amount'):
+                balances[(warehouse_id, material_id, location_id)] += amount
+        entries = StockEntry.objects.filter(pk__gt=since, pk__lte=last_entry)
+        for key, amount in _ledger_totals(entries).items():
+            balances[key] += amount
+
+        snapshot = StockSnapshot.objects.create(last_entry=last_entry)
+        StockSnapshotLine.objects.bulk_create([
+            StockSnapshotLine(snapshot=snapshot, warehouse_id=warehouse_id,
+                              material_id=material_id,
+                              location_id=location_id, amount=amount)
+            for (warehouse_id, material_id, location_id), amount
+            in balances.items() if abs(amount) > EPSILON])
+    return snapshot
+
+
+def differences():
+    """
+    The (warehouse id, material id, location id) keys where the balances
+    differ from the ledger, as key -> (balance, ledger sum)
+    """
+    balances = defaultdict(float)
+    for row in WarehouseMaterial.objects \
+            .values('warehouse', 'material', 'location') \
+            .annotate(total=Sum('amount')).order_by():
+        balances[(row['warehouse'], row['material'], row['location'])] = \
+            row['total']
+    ledger = _ledger_totals(StockEntry.objects.all())
+
+    result = {}
+    for key in set(balances) | set(ledger):
+        balance, total = balances.get(key, 0), ledger.get(key, 0)
+        if abs(balance - total) > EPSILON:
+            result[key] = (balance, total)
+    return result
+
+
+def reconcile(user):
+    """
+    Records a correction for every difference between the balances and the
+    ledger, the balances are left as they are. The first run records the
+    opening balances. Returns the number of corrections.
+    """
+    with transaction.atomic():
+        # No balance changes in the meantime
+        list(WarehouseMaterial.objects.select_for_update()
+             .values_list('pk', flat=True))
+        corrections = [
+            StockEntry(warehouse_id=warehouse_id, material_id=material_id,
+                       location_id=location_id, amount=balance - total,
+                       kind=StockEntry.CORRECTION, created_by=user)
+            for (warehouse_id, material_id, location_id), (balance, total)
+            in differences().items()]
+        StockEntry.objects.bulk_create(corrections)
+    return len(corrections)
+
+
+def _owner_names(owners):
+    """
+    The names DeviceOwner.name gives for the (content type id, object id)
+    pairs, with one query per content type
+    """
+    ids = defaultdict(set)
+    for ct_id, object_id in owners:
+        if ct_id and object_id:
+            ids[ct_id].add(object_id)
+    names = {}
+    for ct_id, object_ids in ids.items():
+        model = ContentType.objects.get_for_id(ct_id).model_class()
+        for obj in model.objects.filter(pk__in=object_ids):
+            names[(ct_id, obj.pk)] = getattr(obj, 'username', None) or \
+                unicode(obj)
+    return names
+
+
+def _reassign_devices(device_ids, movement, user):
+    """
+    Moves the devices to the target warehouse of the movement with bulk
+    updates. The device statuses change like Device.end_life and
+    Device.start_clean, the owner changes get the history notes of
+    DeviceOwner.save.
+    """
+    target = movement.target
+    devices = Device.objects.filter(pk__in=device_ids)
+    if target.owner is None:
+        # Back to the warehouse
+        for status in (Const.DeviceStatus.ACTIVE,
+                       Const.DeviceStatus.TO_UNINSTALL):
+            next_status = Const.DeviceStatus._next_state(
+                Device(status=status))
+            devices.filter(status=status).update(
+                status=next_status,
+                returned_at=Coalesce('returned_at', Value(datetime.now())))
+    else:
+        devices.exclude(status=Const.DeviceStatus.ACTIVE) \
+            .update(status=Const.DeviceStatus.ACTIVE, returned_at=None)
+
+    warehouse_ct = ContentType.objects.get_for_model(Warehouse)
+    device_ct = ContentType.objects.get_for_model(Device)
+    owners = list(DeviceOwner.objects.filter(device__in=device_ids)
+                  .values_list('device', 'content_type', 'object_id'))
+    names = _owner_names((ct_id, object_id) for _, ct_id, object_id in owners)
+    target_name = unicode(target)
+    notes = []
+    for device_id, ct_id, object_id in owners:
+        if (ct_id, object_id) == (warehouse_ct.pk, target.pk):
+            continue
+        notes.append(Note(
+            content_type=device_ct, object_id=device_id, is_history=True,
+            remark=u'Új tulajdonos: {} >> {}'.format(
+                names.get((ct_id, object_id), Const.NO_OWNER), target_name),
+            created_by=user))
+
+    DeviceOwner.objects.filter(device__in=device_ids) \
+        .update(content_type=warehouse_ct, object_id=target.pk)
+    owned = set(device_id for device_id, _, _ in owners)
+    DeviceOwner.objects.bulk_create([
+        DeviceOwner(device_id=device_id, content_type=warehouse_ct,
+                    object_id=target.pk)
+        for device_id in device_ids if device_id not in owned])
+    Note.objects.bulk_create(notes)
+
+
+def finalize(movement, user, progress=None):
+    """
+    Finalizes a material movement in one transaction: the materials are
+    moved from the source to the target warehouse and the devices are
+    reassigned in batches. progress is called with the number of devices
+    done and the total. Returns False if the movement has already been
+    finalized.
+    """
+    with transaction.atomic():
+        movement = MaterialMovement.objects.select_for_update() \
+            .get(pk=movement.pk)
+        if movement.finalized:
+            return False
+
+        totals = defaultdict(float)
+        items = []
+        for material_id, location_id, amount in MaterialMovementMaterial \
+                .objects.filter(materialmovement=movement) \
+                .values_list('material', 'location_to', 'amount'):
+            totals[(movement.source_id, material_id)] += amount
+            items.append((movement.target_id, material_id, location_id,
+                          amount))
+        # What is not in the source (e.g. a delivery from the supplier) is
+        # added to the target all the same
+        take_many(totals, StockEntry.MOVEMENT, user, movement=movement)
+        add_many(items, StockEntry.MOVEMENT, user, movement=movement)
+
+        device_ids = list(DeviceReassignEvent.objects
+                          .filter(materialmovement=movement)
+                          .order_by('pk').values_list('device', flat=True))
+        # A device may have been added to the movement more than once
+        device_ids = sorted(set(device_ids))
+        for start in range(0, len(device_ids), DEVICE_BATCH_SIZE):
+            batch = device_ids[start:start + DEVICE_BATCH_SIZE]
+            _reassign_devices(batch, movement, user)
+            if progress:
+                progress(start + len(batch), len(device_ids))
+
+        movement.finalized = True
+        movement.save()
+    return True
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import glob
+import tempfile
+
+from rovidtav import settings
+
+
+class ThumbnailCache(object):
+    """
+    On-disk thumbnail cache with a size bounded LRU eviction. The entries
+    are keyed by the attachment table, the attachment id and the thumbnail
+    size, the modification time of the files is used as the last access time.
+
+    The size of the cache is tracked in memory. The directory is scanned
+    when the first entry is stored and when the tracked size exceeds
+    max_bytes. The scan also picks up the entries written by the other
+    processes.
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root or settings.THUMBNAIL_CACHE_ROOT
+        self.max_bytes = max_bytes or settings.THUMBNAIL_CACHE_MAX_BYTES
+        # Bytes in the cache, None until the first scan
+        self._size = None
+
+    def _prefix(self, attachment):
+        return u'{}_{}_'.format(attachment._meta.db_table, attachment.pk)
+
+    def key(self, attachment, size=None):
+        return u'{}{}'.format(self._prefix(attachment),
+                              size or settings.IMAGE_THUMB_PX)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        """
+        Returns the cached bytes or None if the key is not cached
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as cached:
+                data = cached.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            # Mark as recently used
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        try:
+            os.makedirs(self.root)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        if self._size is None:
+            self.evict()
+        path = self.path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(data)
+            replaced = self._file_size(path)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._size += len(data) - replaced
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _file_size(self, path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def get_or_create(self, key, generator):
+        """
+        Returns the cached bytes, calls generator() to create them on a miss
+        """
+        data = self.get(key)
+        if data is None:
+            data = generator()
+            self.put(key, data)
+        return data
+
+    def invalidate(self, attachment):
+        """
+        Removes every cached size of an attachment
+        """
+        pattern = self.path(self._prefix(attachment) + u'*')
+        for path in glob.glob(pattern):
+            size = self._file_size(path)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            if self._size is not None:
+                self._size = max(self._size - size, 0)
+
+    def evict(self):
+        """
+        Scans the cache and removes the least recently used entries until it
+        fits into max_bytes
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            if name.startswith('.tmp'):
+                continue
+            try:
+                stat = os.stat(self.path(name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+
+        if total > self.max_bytes:
+            for _, size, name in sorted(entries):
+                try:
+                    os.remove(self.path(name))
+                except OSError:
+                    continue
+                total -= size
+                if total <= self.max_bytes:
+                    break
+        self._size = total
+
+
+_thumbnail_cache = None
+
+
+def get_thumbnail_cache():
+    global _thumbnail_cache
+    if _thumbnail_cache is None:
+        _thumbnail_cache = ThumbnailCache()
+    return _thumbnail_cache